@@ -0,0 +1,90 @@
+"""
+selection of the GF(2) linear algebra backend
+
+By default the packed matrices and vectors from gf2 are used. Set the environment variable
+LOWMC_BACKEND=sage to run the scripts with SageMath instead, e.g., to cross-check the results.
+"""
+
+import os
+
+BACKEND = os.environ.get("LOWMC_BACKEND", "gf2")
+
+if BACKEND == "sage":
+    from sage.all import GF, matrix, vector, copy, random_vector
+
+    F = GF(2)
+
+    def mirror(m):
+        """
+        calculate P * m * P (or P * m for vectors) for the anti-diagonal matrices P
+        """
+        if hasattr(m, "nrows"):
+            return m.matrix_from_rows_and_columns(
+                list(reversed(range(m.nrows()))), list(reversed(range(m.ncols())))
+            )
+        return vector(F, list(reversed(m.list())))
+
+    def pack_rows(mat):
+        """
+        pack the rows of mat into integers, where bit j is the entry in column j
+        """
+        rows = [0] * mat.nrows()
+        for i, j in mat.nonzero_positions():
+            rows[i] |= 1 << j
+        return rows
+
+    def unpack_rows(rows, ncols):
+        """
+        build a matrix from rows packed into integers
+        """
+        return matrix(F, len(rows), ncols, [[(row >> j) & 1 for j in range(ncols)] for row in rows])
+
+    def pack_vector(v):
+        """
+        pack v into an integer, where bit j is entry j
+        """
+        return sum(1 << j for j in v.nonzero_positions())
+
+    def unpack_vector(value, length):
+        """
+        build a vector from an integer
+        """
+        return vector(F, [(value >> j) & 1 for j in range(length)])
+
+elif BACKEND == "gf2":
+    from gf2 import GF, matrix, vector, copy, random_vector, Matrix, Vector
+
+    F = GF(2)
+
+    def mirror(m):
+        """
+        calculate P * m * P (or P * m for vectors) for the anti-diagonal matrices P
+        """
+        return m.mirror()
+
+    def pack_rows(mat):
+        """
+        pack the rows of mat into integers, where bit j is the entry in column j
+        """
+        return mat.packed_rows()
+
+    def unpack_rows(rows, ncols):
+        """
+        build a matrix from rows packed into integers
+        """
+        return Matrix.from_packed_rows(rows, ncols)
+
+    def pack_vector(v):
+        """
+        pack v into an integer, where bit j is entry j
+        """
+        return v.packed()
+
+    def unpack_vector(value, length):
+        """
+        build a vector from an integer
+        """
+        return Vector(length, value)
+
+else:
+    raise ImportError("Unknown backend: {}".format(BACKEND))
@@ -0,0 +1,313 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark the phases of the constant generation and the LowMC implementations.
+
+For every instance the following phases are measured, each one in a fresh process:
+
+  grain            generate the bits of 10 n x n matrices with the Grain SSG
+  instantiate      instantiate 10 n x n matrices and their inverses
+  rrkc             reduced round key computation
+  rll              optimized linear layer precomputation
+  emit             format the tables of the instance as C code
+  enc, enc_transposed, enc_rrkc, enc_rrkc_rll, enc_rrkc_rll_int
+                   encrypt --encryptions random blocks one at a time
+  enc_batch, enc_transposed_batch, enc_rrkc_batch, enc_rrkc_rll_batch
+                   encrypt --batch random blocks with one bitsliced call
+
+Every phase is run --repeat times after its setup, and the minimum and the median of the wall
+times as well as the peak RSS are written to a JSON file, for the encryptions also the blocks per
+second of the fastest run. If a baseline (a JSON file written by an earlier run) is given, phases
+whose minimum wall time (blocks per second for the encryptions) or peak RSS got worse by more than
+--threshold are reported as regressions.
+
+Besides the instances of the Makefile, synthetic instances with random matrices can be given as
+--synthetic n,r,s to measure the scaling for large n.
+"""
+
+from __future__ import print_function
+
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+from backend import F, vector
+from build_all import PARAMETER_SETS
+from cache import PrecomputationCache
+from generate_matrices import GrainSSG, instantiate_matrix, test_candidate
+from generate_matrices import main as generate
+from instance_file import instance_filename, open_instance, write_instance
+from lowmc import LowMC
+from precomputations import compute_rrkc, compute_rll
+from process_matrices import SourceTables, load_matrices, snip_r_wedge
+from profiling import peak_rss
+
+BATCH_PHASES = ("enc_batch", "enc_transposed_batch", "enc_rrkc_batch", "enc_rrkc_rll_batch")
+PHASES = (
+    "grain", "instantiate", "rrkc", "rll", "emit",
+    "enc", "enc_transposed", "enc_rrkc", "enc_rrkc_rll", "enc_rrkc_rll_int",
+) + BATCH_PHASES
+
+
+def write_synthetic_instance(n, r, seed=0):
+    """
+    write an instance with random full rank matrices (instead of the Grain stream)
+    """
+    rng = random.Random(seed)
+
+    def full_rank(inverse):
+        while True:
+            candidate = test_candidate(n, n, rng.getrandbits(n * n), inverse)
+            if candidate is not None:
+                return candidate
+
+    linlayers = [full_rank(True) for _ in range(r)]
+    write_instance(
+        instance_filename(n, n, r), n, n, r,
+        [mat for mat, _ in linlayers],
+        [full_rank(False)[0] for _ in range(r + 1)],
+        [rng.getrandbits(n) for _ in range(r)],
+        [inv for _, inv in linlayers],
+    )
+
+
+def _setup(phase, n, k, r, s, encryptions, batch):
+    """
+    prepare a phase and return the function to be measured
+    """
+    if phase == "grain":
+        gen = GrainSSG()
+        return lambda: gen.bits(10 * n * n)
+
+    if phase == "instantiate":
+        gen = GrainSSG()
+        return lambda: [instantiate_matrix(n, n, gen, inverse=True, packed=True) for _ in range(10)]
+
+    if phase in ("rrkc", "rll", "emit"):
+        with open_instance(n, k, r) as inst:
+            Lt, Kt, C, Li = load_matrices(inst)
+
+    if phase == "rrkc":
+        return lambda: compute_rrkc(Lt, Kt, C, n, s, Li)
+
+    if phase == "rll":
+        return lambda: compute_rll(Lt, n, s)
+
+    if phase == "emit":
+        rrkc = compute_rrkc(Lt, Kt, C, n, s, Li)
+        rll = compute_rll(Lt, n, s)
+
+        def emit():
+            tables = SourceTables(io.StringIO(), "block_t")
+            for i, m in enumerate(Lt):
+                tables.matrix("L_{}".format(i), m)
+            for i, m in enumerate(Kt):
+                tables.matrix("K_{}".format(i), m)
+            for i, c in enumerate(C):
+                tables.vector("C_{}".format(i), c)
+            tables.matrix("precomputed_round_key_matrix_linear_part", rrkc["key_linear"])
+            for i, m in enumerate(rll["Z_i"]):
+                tables.matrix("Zi_{}".format(i), m.transpose())
+            for i, (m, cols) in enumerate(zip(rll["R_wedge"], rll["R_cols"])):
+                tables.matrix("Ri_{}".format(i), snip_r_wedge(m, cols))
+            tables.matrix("Z_r", rll["Z_r"])
+
+        return emit
+
+    lowmc = LowMC(n, k, s, r, cache=PrecomputationCache(directory=""))
+    enc = getattr(lowmc, phase)
+    rng = random.Random(0)
+    if phase in BATCH_PHASES:
+        keys = [rng.getrandbits(k) for _ in range(batch)]
+        plaintexts = [rng.getrandbits(n) for _ in range(batch)]
+        # precomputations and packed matrices are not part of the measurement
+        enc(keys[:1], plaintexts[:1])
+        return lambda: enc(keys, plaintexts)
+
+    inputs = [
+        (vector(F, [rng.getrandbits(1) for _ in range(k)]),
+         vector(F, [rng.getrandbits(1) for _ in range(n)]))
+        for _ in range(encryptions)
+    ]
+    # precomputations and lazily built matrices are not part of the measurement
+    enc(*inputs[0])
+
+    def encrypt():
+        for key, plaintext in inputs:
+            enc(key, plaintext)
+
+    return encrypt
+
+
+def _run(args):
+    """
+    run one phase repeat times in the current (fresh) process, return the wall times and the peak
+    RSS
+    """
+    phase, (n, k, r, s), workdir, encryptions, batch, repeat = args
+    os.chdir(workdir)
+    run = _setup(phase, n, k, r, s, encryptions, batch)
+    walls = []
+    for _ in range(repeat):
+        start = time.time()
+        run()
+        walls.append(time.time() - start)
+    return walls, peak_rss()
+
+
+def instance_name(params, synthetic=False):
+    return "{}lowmc_{}_{}_{}_{}".format("synthetic_" if synthetic else "", *params)
+
+
+def run_benchmarks(instances, phases=PHASES, encryptions=10, workdir=".", repeat=5, batch=1024):
+    """
+    run the phases for all (params, synthetic) in instances, return the list of results
+    """
+    # spawn a new interpreter per phase, so that the peak RSS is that of the phase alone
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for params, synthetic in instances:
+        n, k, r, s = params
+        directory = os.path.abspath(os.path.join(workdir, "synthetic") if synthetic else workdir)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not os.path.exists(os.path.join(directory, instance_filename(n, k, r))):
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                if synthetic:
+                    write_synthetic_instance(n, r)
+                else:
+                    generate(n, k, r)
+            finally:
+                os.chdir(cwd)
+
+        name = instance_name(params, synthetic)
+        for phase in phases:
+            pool = context.Pool(1, maxtasksperchild=1)
+            try:
+                walls, rss = pool.apply(
+                    _run, ((phase, params, directory, encryptions, batch, repeat),))
+            finally:
+                pool.close()
+                pool.join()
+            wall = min(walls)
+            median = statistics.median(walls)
+            result = {
+                "instance": name,
+                "phase": phase,
+                "repeat": len(walls),
+                "wall": wall,
+                "wall_median": median,
+                "peak_rss": rss,
+            }
+            throughput = ""
+            if phase.startswith("enc"):
+                result["blocks"] = batch if phase in BATCH_PHASES else encryptions
+                result["blocks_per_second"] = result["blocks"] / wall if wall else float("inf")
+                throughput = ", {:.0f} blocks/s".format(result["blocks_per_second"])
+            print("{} {}: min {:.3f}s, median {:.3f}s{}, {} KiB".format(
+                name, phase, wall, median, throughput, rss))
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    return (entry, baseline entry, metric) for the results whose minimum wall time (blocks per
+    second for the encryptions) or peak RSS got worse by more than threshold compared with the
+    baseline
+    """
+    previous = dict(((entry["instance"], entry["phase"]), entry) for entry in baseline["results"])
+    regressions = []
+    for entry in results:
+        old = previous.get((entry["instance"], entry["phase"]))
+        if old is None:
+            continue
+        if "blocks_per_second" in entry and "blocks_per_second" in old:
+            if entry["blocks_per_second"] * (1 + threshold) < old["blocks_per_second"]:
+                regressions.append((entry, old, "blocks_per_second"))
+        elif "wall" in old and entry["wall"] > old["wall"] * (1 + threshold):
+            regressions.append((entry, old, "wall"))
+        if "peak_rss" in old and entry["peak_rss"] > old["peak_rss"] * (1 + threshold):
+            regressions.append((entry, old, "peak_rss"))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("instances", nargs="*", metavar="n,k,r,s",
+                        help="parameters of the instances (default: all instances)")
+    parser.add_argument("--synthetic", action="append", default=[], metavar="n,r,s",
+                        help="add a synthetic instance with random matrices")
+    parser.add_argument("--phase", action="append", choices=PHASES,
+                        help="phases to run (default: all)")
+    parser.add_argument("--encryptions", type=int, default=10,
+                        help="number of encryptions per variant")
+    parser.add_argument("--batch", type=int, default=1024,
+                        help="number of blocks per call of the batch variants (default: 1024)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs of every phase (default: 5)")
+    parser.add_argument("--workdir", default=".",
+                        help="directory of the instance files, missing ones are generated")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON output file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative increase of the wall time or the peak RSS reported as "
+                             "regression (default: 0.1)")
+    args = parser.parse_args(argv)
+
+    instances = [(tuple(map(int, p.split(","))), False) for p in args.instances]
+    if not instances and not args.synthetic:
+        instances = [(params, False) for params in PARAMETER_SETS]
+    for p in args.synthetic:
+        n, r, s = map(int, p.split(","))
+        instances.append(((n, n, r, s), True))
+
+    if args.repeat < 1:
+        parser.error("--repeat has to be positive")
+    if args.batch < 1:
+        parser.error("--batch has to be positive")
+
+    results = run_benchmarks(instances, args.phase or PHASES, args.encryptions, args.workdir,
+                             args.repeat, args.batch)
+    with io.open(args.output, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with io.open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for entry, old, metric in regressions:
+            if metric == "wall":
+                print("REGRESSION {} {}: {:.3f}s (baseline {:.3f}s)".format(
+                    entry["instance"], entry["phase"], entry["wall"], old["wall"]))
+            elif metric == "blocks_per_second":
+                print("REGRESSION {} {}: {:.0f} blocks/s (baseline {:.0f} blocks/s)".format(
+                    entry["instance"], entry["phase"], entry["blocks_per_second"],
+                    old["blocks_per_second"]))
+            else:
+                print("REGRESSION {} {}: {} KiB peak RSS (baseline {} KiB)".format(
+                    entry["instance"], entry["phase"], entry["peak_rss"], old["peak_rss"]))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+
+"""
+Generate and process the matrices and constants of several LowMC instances in one go.
+
+The modules are imported once and the instances are distributed over a pool of worker processes,
+so that the total time is dominated by the slowest instance.
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import time
+
+import generate_matrices
+import process_matrices
+
+# (n, k, r, s) of the instances built by the Makefile
+PARAMETER_SETS = [
+    (256, 256, 38, 10),
+    (192, 192, 30, 10),
+    (128, 128, 20, 10),
+    (256, 256, 363, 1),
+    (192, 192, 284, 1),
+    (128, 128, 182, 1),
+]
+
+
+def build_instance(params, m4ri_tables=False, blob=False):
+    """
+    generate and process one instance, return the wall times of both steps
+    """
+    n, k, r, s = params
+    start = time.time()
+    generate_matrices.main(n, k, r)
+    generated = time.time()
+    process_matrices.main(n, k, r, s, m4ri_tables=m4ri_tables, blob=blob)
+    return params, generated - start, time.time() - generated
+
+
+def _build_instance(args):
+    return build_instance(*args)
+
+
+def main(parameter_sets=PARAMETER_SETS, processes=None, m4ri_tables=False, blob=False):
+    """
+    build all instances in parallel and report the wall time per instance
+    """
+    # start the slow instances first
+    parameter_sets = sorted(parameter_sets, key=lambda p: p[0] * p[0] * p[2], reverse=True)
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    results = []
+    try:
+        for params, generate_time, process_time in pool.imap_unordered(
+            _build_instance, [(params, m4ri_tables, blob) for params in parameter_sets]
+        ):
+            print(
+                "lowmc_{}_{}_{}: generate {:.1f}s, process {:.1f}s, total {:.1f}s".format(
+                    params[0], params[1], params[2], generate_time, process_time,
+                    generate_time + process_time
+                )
+            )
+            results.append((params, generate_time, process_time))
+    finally:
+        pool.close()
+        pool.join()
+    print("all instances: {:.1f}s".format(time.time() - start))
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--m4ri-tables", action="store_true",
+                        help="emit the precomputed M4RI tables")
+    parser.add_argument("--blob", action="store_true",
+                        help="write the tables to binary blobs included with .incbin")
+    parser.add_argument("instances", nargs="*", metavar="n,k,r,s",
+                        help="parameters of the instances (default: all instances)")
+    args = parser.parse_args()
+
+    parameter_sets = [tuple(map(int, p.split(","))) for p in args.instances] or PARAMETER_SETS
+    main(parameter_sets, args.jobs, args.m4ri_tables, args.blob)
@@ -0,0 +1,220 @@
+"""
+persistent content-addressed cache of derived precomputation matrices
+
+Entries are identified by a hash of the instance data, the number of S-boxes, the precomputation
+stage and ALGORITHM_VERSION. They are stored as files containing the matrices and vectors with
+bit-packed rows, preceded by a SHA-256 hash of the entries, which is checked when the entry is
+read. If the cache grows beyond its maximum size, the least recently used entries are
+evicted.
+
+The cache directory is taken from LOWMC_CACHE_DIR (default: ~/.cache/lowmc), setting it to an
+empty string disables the cache. The maximum size in bytes is taken from LOWMC_CACHE_SIZE.
+"""
+
+import hashlib
+import io
+import os
+import struct
+import tempfile
+
+from backend import pack_rows, unpack_rows, pack_vector, unpack_vector
+from precomputations import ALGORITHM_VERSION
+from profiling import PROFILE
+
+MAGIC = b"LOWMCPC\x02"
+DEFAULT_MAX_SIZE = 1 << 30
+
+
+def instance_digest(inst):
+    """
+    hash of the instance file inst, i.e., of the header and all matrices and constants
+    """
+    return hashlib.sha256(inst.data).hexdigest()
+
+
+def _encode(value, out):
+    if isinstance(value, list):
+        out.append(b"L" + struct.pack("<I", len(value)))
+        for entry in value:
+            _encode(entry, out)
+    elif isinstance(value, int):
+        out.append(b"i" + struct.pack("<q", value))
+    elif hasattr(value, "nrows"):
+        nbytes = (value.ncols() + 7) // 8
+        out.append(b"M" + struct.pack("<II", value.nrows(), value.ncols()))
+        out.append(b"".join(row.to_bytes(nbytes, "little") for row in pack_rows(value)))
+    else:
+        out.append(b"V" + struct.pack("<I", len(value)))
+        out.append(pack_vector(value).to_bytes((len(value) + 7) // 8, "little"))
+
+
+def _decode(data, offset):
+    kind = data[offset:offset + 1]
+    offset += 1
+    if kind == b"L":
+        (count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        value = []
+        for _ in range(count):
+            entry, offset = _decode(data, offset)
+            value.append(entry)
+        return value, offset
+    if kind == b"i":
+        return struct.unpack_from("<q", data, offset)[0], offset + 8
+    if kind == b"M":
+        nrows, ncols = struct.unpack_from("<II", data, offset)
+        offset += 8
+        nbytes = (ncols + 7) // 8
+        rows = [int.from_bytes(data[offset + i * nbytes:offset + (i + 1) * nbytes], "little")
+                for i in range(nrows)]
+        return unpack_rows(rows, ncols), offset + nrows * nbytes
+    if kind == b"V":
+        (length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        nbytes = (length + 7) // 8
+        value = int.from_bytes(data[offset:offset + nbytes], "little")
+        return unpack_vector(value, length), offset + nbytes
+    raise ValueError("Invalid cache entry")
+
+
+def encode_entries(entries):
+    """
+    serialize a dict of matrices, vectors, integers and (nested) lists thereof
+    """
+    out = [struct.pack("<I", len(entries))]
+    for name in sorted(entries):
+        encoded = name.encode("utf-8")
+        out.append(struct.pack("<I", len(encoded)) + encoded)
+        _encode(entries[name], out)
+    payload = b"".join(out)
+    return MAGIC + hashlib.sha256(payload).digest() + payload
+
+
+def decode_entries(data):
+    """
+    deserialize the entries written by encode_entries
+
+    Raises ValueError if the hash does not match or if the data is not consumed completely.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Invalid cache entry")
+    offset = len(MAGIC) + hashlib.sha256().digest_size
+    if hashlib.sha256(data[offset:]).digest() != data[len(MAGIC):offset]:
+        raise ValueError("Corrupted cache entry")
+    (count,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    entries = {}
+    for _ in range(count):
+        (length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        name = data[offset:offset + length].decode("utf-8")
+        entries[name], offset = _decode(data, offset + length)
+    if offset != len(data):
+        raise ValueError("Invalid cache entry")
+    return entries
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class PrecomputationCache(object):
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = os.environ.get(
+                "LOWMC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lowmc")
+            )
+        if max_size is None:
+            max_size = int(os.environ.get("LOWMC_CACHE_SIZE", DEFAULT_MAX_SIZE))
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def key(self, digest, stage, sboxes):
+        return hashlib.sha256(
+            "{}:{}:{}:{}".format(digest, stage, sboxes, ALGORITHM_VERSION).encode("utf-8")
+        ).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def get(self, key):
+        """
+        return the cached entries for key or None
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with io.open(path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            entries = decode_entries(data)
+        except (ValueError, IndexError, struct.error):
+            os.remove(path)
+            return None
+        # mark as recently used
+        os.utime(path, None)
+        return entries
+
+    def put(self, key, entries):
+        if not self.enabled:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        data = encode_entries(entries)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp creates the file with mode 0600, use the mode of regular files instead
+        os.chmod(tmp, 0o666 & ~_umask())
+        os.rename(tmp, self._path(key))
+        self.evict()
+
+    def get_or_compute(self, digest, stage, sboxes, compute):
+        """
+        return the entries of a precomputation stage from the cache, or compute and store them
+        """
+        if not self.enabled:
+            return compute()
+        key = self.key(digest, stage, sboxes)
+        entries = self.get(key)
+        if entries is None:
+            PROFILE.count("cache misses")
+            entries = compute()
+            self.put(key, entries)
+        else:
+            PROFILE.count("cache hits")
+        return entries
+
+    def evict(self):
+        """
+        remove the least recently used entries until the cache fits into max_size
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
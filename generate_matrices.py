@@ -1,100 +1,513 @@
-#! /usr/bin/env sage
+#! /usr/bin/env python3
 
-from sage.all import GF, matrix
-from six.moves import range
-import pickle
+from gf2 import Eliminator
+from instance_file import InstanceWriter, instance_filename, open_instance
+from profiling import PROFILE, profile_filename
+import collections
 import io
-
-
-F = GF(2)
+import multiprocessing
+import struct
 
 
 class Instance(object):
-    def __init__(self, n, k, r, L, K, R):
+    def __init__(self, n, k, r, L, K, R, Linv=None):
         self.n = n
         self.k = k
         self.r = r
         self.L = L
         self.K = K
         self.R = R
+        self.Linv = Linv
 
 
-def main(blocksize=256, keysize=256, rounds=19):
+def main(blocksize=256, keysize=256, rounds=19, processes=1):
     ''' Use the global parameters `blocksize`, `keysize` and `rounds`
         to create the set of matrices and constants for the corresponding
         LowMC instance. Save those in a file named
-        `matrices_and_constants.dat`.
+        `matrices_and_constants_{blocksize}_{keysize}_{rounds}.bin` and the
+        state of the generator at the start of every matrix and constant in
+        `matrices_and_constants_{blocksize}_{keysize}_{rounds}.idx`.
+
+        Every matrix and constant is written to the instance file as soon as
+        it is generated, so only one of them is kept in memory.
+
+        If `processes` is not 1, the candidate matrices are tested
+        speculatively in a pool of worker processes (None for one per CPU),
+        see `instantiate_matrices`, and accepted in stream order, so the
+        output is identical to the sequential one. The Grain stream is still
+        generated by this process, only the rank tests run in parallel.
+    '''
+    with InstanceWriter(instance_filename(blocksize, keysize, rounds), blocksize, keysize,
+                        rounds) as writer, PROFILE.phase('generate'):
+        if processes == 1:
+            checkpoints = generate_sequential(blocksize, keysize, rounds, writer)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                checkpoints = generate_speculative(
+                    blocksize, keysize, rounds, pool, writer,
+                    window=4 * (processes or multiprocessing.cpu_count()))
+            finally:
+                pool.close()
+                pool.join()
+
+    write_checkpoints(checkpoint_filename(blocksize, keysize, rounds), blocksize, keysize,
+                      rounds, checkpoints)
+
+
+def write_section(writer, section, i, value):
+    ''' Write the value returned by `generate_section` to the instance
+        writer `writer`.
+    '''
+    with PROFILE.phase('write'):
+        if section == 'L':
+            writer.write('L', i, value[0])
+            writer.write('Linv', i, value[1])
+        elif section == 'R':
+            writer.write('R', i, [value])
+        else:
+            writer.write('K', i, value)
+
+
+def generate_sequential(blocksize, keysize, rounds, writer):
+    ''' Generate the matrices and constants of an instance one after another
+        and pass them to `writer`. Returns the checkpoints.
+    '''
+    gen = GrainSSG()
+    checkpoints = []
+    for section, i in stream_order(rounds):
+        checkpoints.append((section, i, gen.getstate()))
+        with PROFILE.round(section, i):
+            value = generate_section(section, blocksize, keysize, gen)
+        write_section(writer, section, i, value)
+    return checkpoints
+
+
+def generate_speculative(blocksize, keysize, rounds, pool, writer, window=None):
+    ''' Generate the matrices and constants of an instance with the rank tests
+        running in the worker processes of `pool`, see `instantiate_matrices`,
+        and pass them to `writer`. The results are identical to those of
+        `generate_sequential`.
+    '''
+    gen = GrainSSG()
+    checkpoints = []
+    for section, count in (('L', rounds), ('R', rounds), ('K', rounds + 1)):
+        if section == 'R':
+            for i in range(count):
+                checkpoints.append((section, i, gen.getstate()))
+                write_section(writer, section, i, gen.bits(blocksize))
+            continue
+        columns = blocksize if section == 'L' else keysize
+        for i, (state, (mat, inv)) in enumerate(instantiate_matrices(
+                count, blocksize, columns, gen, pool, section == 'L', window)):
+            checkpoints.append((section, i, state))
+            write_section(writer, section, i, (mat, inv) if section == 'L' else mat)
+    return checkpoints
+
+
+def stream_order(rounds):
+    ''' The matrices and constants in the order in which their bits are taken
+        from the generator: the linear layers, the round constants and the
+        round key matrices.
+    '''
+    return [('L', i) for i in range(rounds)] + [('R', i) for i in range(rounds)] + \
+        [('K', i) for i in range(rounds + 1)]
+
+
+def generate_section(section, blocksize, keysize, gen):
+    ''' Generate the next linear layer and its inverse ('L'), round constant
+        ('R') or round key matrix ('K') from `gen` as packed rows.
+    '''
+    if section == 'L':
+        return instantiate_matrix(blocksize, blocksize, gen, inverse=True, packed=True)
+    if section == 'K':
+        return instantiate_matrix(blocksize, keysize, gen, packed=True)
+    return gen.bits(blocksize)
+
+
+def checkpoint_filename(blocksize, keysize, rounds):
+    return 'matrices_and_constants_{}_{}_{}.idx'.format(blocksize, keysize, rounds)
+
+
+_CHECKPOINT_MAGIC = b'LOWMCIDX'
+_CHECKPOINT_HEADER = struct.Struct('<8sIIIII')
+_CHECKPOINT_ENTRY = struct.Struct('<cxxxIQQI10s')
+
+
+def write_checkpoints(filename, blocksize, keysize, rounds, checkpoints):
+    ''' Write the list of `(section, round, state)` checkpoints. '''
+    data = [_CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, 1, blocksize, keysize, rounds,
+                                    len(checkpoints))]
+    for section, i, state in checkpoints:
+        data.append(_CHECKPOINT_ENTRY.pack(section.encode('ascii'), i, state.steps,
+                                           state.position, state.npending,
+                                           state.lfsr.to_bytes(10, 'little')))
+        data.append(state.pending.to_bytes((state.npending + 7) // 8, 'little'))
+    with io.open(filename, 'wb') as f:
+        f.write(b''.join(data))
+
+
+def read_checkpoints(filename):
+    ''' Read the checkpoints written by `write_checkpoints` into a dict
+        mapping `(section, round)` to the state of the generator.
     '''
-    gen = grain_ssg()
-    linlayers = []
-    for _ in range(rounds):
-        linlayers.append(instantiate_matrix(blocksize, blocksize, gen))
+    with io.open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, blocksize, keysize, rounds, count = \
+        _CHECKPOINT_HEADER.unpack_from(data, 0)
+    if magic != _CHECKPOINT_MAGIC or version != 1:
+        raise ValueError('{} is not a checkpoint index'.format(filename))
+    offset = _CHECKPOINT_HEADER.size
+    checkpoints = {}
+    for _ in range(count):
+        section, i, steps, position, npending, lfsr = \
+            _CHECKPOINT_ENTRY.unpack_from(data, offset)
+        offset += _CHECKPOINT_ENTRY.size
+        length = (npending + 7) // 8
+        pending = int.from_bytes(data[offset:offset + length], 'little')
+        offset += length
+        checkpoints[(section.decode('ascii'), i)] = GrainState(
+            int.from_bytes(lfsr, 'little'), steps, pending, npending, position)
+    return (blocksize, keysize, rounds), checkpoints
 
-    round_constants = []
-    for _ in range(rounds):
-        constant = [next(gen) for _ in range(blocksize)]
-        round_constants.append(constant)
 
-    roundkey_matrices = []
-    for _ in range(rounds + 1):
-        mat = instantiate_matrix(blocksize, keysize, gen)
-        roundkey_matrices.append(mat)
+def seek(blocksize, keysize, rounds, section, i):
+    ''' Return a generator positioned at the start of the linear layer
+        ('L'), round constant ('R') or round key matrix ('K') of round `i`.
+    '''
+    params, checkpoints = read_checkpoints(checkpoint_filename(blocksize, keysize, rounds))
+    if params != (blocksize, keysize, rounds):
+        raise ValueError('Unexpected LowMC instance.')
+    return GrainSSG(checkpoints[(section, i)])
 
-    inst = Instance(blocksize, keysize, rounds, linlayers, roundkey_matrices,
-            round_constants)
-    with io.open('matrices_and_constants_{}_{}_{}.pickle'.format(blocksize, keysize, rounds), 'wb') as matfile:
-        pickle.dump(inst, matfile, protocol=2)
+
+def regenerate(blocksize, keysize, rounds, section, i):
+    ''' Regenerate a single matrix or constant without replaying the stream
+        of the previous ones.
+    '''
+    gen = seek(blocksize, keysize, rounds, section, i)
+    return generate_section(section, blocksize, keysize, gen)
 
 
-def instantiate_matrix(n, m, gen):
+def _verify_section(args):
+    (blocksize, keysize, rounds), section, i, state = args
+    value = generate_section(section, blocksize, keysize, GrainSSG(state))
+    with open_instance(blocksize, keysize, rounds) as inst:
+        if section == 'L':
+            expected = (inst.rows('L', i), inst.rows('Linv', i) if inst.has_inverses else None)
+            if not inst.has_inverses:
+                value = (value[0], None)
+        elif section == 'R':
+            expected = inst.constant(i)
+        else:
+            expected = inst.rows('K', i)
+    return section, i, value == expected
+
+
+def verify(blocksize, keysize, rounds, processes=None):
+    ''' Regenerate all matrices and constants from their checkpoints in
+        parallel and compare them with the instance file. Returns the list of
+        `(section, round)` that differ.
+    '''
+    params, checkpoints = read_checkpoints(checkpoint_filename(blocksize, keysize, rounds))
+    if params != (blocksize, keysize, rounds):
+        raise ValueError('Unexpected LowMC instance.')
+    jobs = [(params, section, i, checkpoints[(section, i)])
+            for section, i in stream_order(rounds)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_verify_section, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return [(section, i) for section, i, ok in results if not ok]
+
+
+def instantiate_matrix(n, m, gen, inverse=False, packed=False):
     ''' Instantiate a matrix of maximal rank using bits from the
         generatator `gen`.
+
+        Every candidate consumes the next n * m bits of `gen`, see
+        `test_candidate`. If `inverse` is set, the inverse of the (square)
+        matrix is returned as well. If `packed` is set, the rows are returned
+        as integers, where bit j is the entry in column j.
     '''
     while True:
-        mat = []
-        for _ in range(n):
-            row = []
-            for _ in range(m):
-                row.append(next(gen))
-            mat.append(row)
-        sagem = matrix(F, mat)
-        if sagem.rank() >= min(n, m):
-            return mat
+        bits = gen.bits(n * m)
+        with PROFILE.phase('rank test'):
+            candidate = test_candidate(n, m, bits, inverse)
+        if candidate is not None:
+            break
+        PROFILE.count('rejected candidates')
+    mat, inv = candidate
+    if not packed:
+        mat = [unpack_bits(row, m) for row in mat]
+    if not inverse:
+        return mat
+    if not packed:
+        inv = [unpack_bits(row, n) for row in inv]
+    return mat, inv
+
+
+def test_candidate(n, m, bits, inverse=False):
+    ''' Test whether the n x m matrix with the rows packed into `bits` (the
+        first row in the least significant bits) has maximal rank.
+
+        The rows are eliminated one after another and the candidate is
+        rejected as soon as too many dependent rows showed up. Returns None
+        for rejected candidates, and the packed rows and the inverse (if
+        `inverse` is set) otherwise.
+    '''
+    dependent_rows = n - min(n, m)
+    mask = (1 << m) - 1
+    mat = []
+    eliminator = Eliminator(m, track=inverse)
+    for row in range(n):
+        mat.append((bits >> (row * m)) & mask)
+        if not eliminator.add(mat[-1])[0]:
+            dependent_rows -= 1
+            if dependent_rows < 0:
+                return None
+    return mat, eliminator.inverse() if inverse else None
+
+
+def _test_candidate(args):
+    return test_candidate(*args)
+
+
+def instantiate_matrices(count, n, m, gen, pool, inverse=False, window=None):
+    ''' Instantiate `count` matrices like `instantiate_matrix`, testing the
+        candidates speculatively in the worker processes of `pool`.
+
+        As every candidate consumes n * m bits, the candidates are the
+        consecutive windows of n * m bits of the stream, no matter how many
+        were rejected before. The stream is read ahead and up to `window`
+        windows are kept in flight, i.e., the candidates after no, one, two,
+        ... further rejections are tested concurrently, and a new window is
+        submitted whenever the oldest result is committed. The results are
+        committed in stream order, and `gen` is finally rewound to the end of
+        the last accepted candidate. Hence the results and the state of `gen`
+        are identical to the sequential ones.
+
+        Only the rank tests run in parallel, the stream is still generated by
+        the calling process (see `main`).
+
+        Yields the state of `gen` at the start of every matrix and the packed
+        rows and inverse of the matrix.
+    '''
+    pending = collections.deque()
+    start = None
+    accepted = 0
+    while accepted < count:
+        # a random square matrix over GF(2) has full rank with a probability
+        # of about 0.29, so do not read further ahead than about 4 candidates
+        # per missing matrix
+        limit = 4 * (count - accepted)
+        while len(pending) < (limit if window is None else min(limit, window)):
+            state = gen.getstate()
+            pending.append((state, pool.apply_async(_test_candidate,
+                                                    ((n, m, gen.bits(n * m), inverse),))))
+        state, job = pending.popleft()
+        if start is None:
+            start = state
+        candidate = job.get()
+        if candidate is None:
+            PROFILE.count('rejected candidates')
+            continue
+        yield start, candidate
+        start = None
+        accepted += 1
+    if pending:
+        # discard the windows read ahead beyond the last matrix
+        gen.setstate(pending[0][0])
+
+
+def unpack_bits(value, count):
+    ''' Unpack the `count` least significant bits of `value` into a list,
+        starting with the least significant bit.
+    '''
+    return [int(b) for b in reversed('{:0{}b}'.format(value, count))]
+
+
+def _ssg_table():
+    ''' For each byte of the LFSR output, i.e., four (choice, bit) pairs,
+        the bits kept by the self-shrinking generator and their number.
+    '''
+    small = []
+    for byte in range(256):
+        value, count = 0, 0
+        for pair in range(4):
+            if (byte >> (2 * pair)) & 1:
+                value |= ((byte >> (2 * pair + 1)) & 1) << count
+                count += 1
+        small.append((value, count))
+    return [(lv | (hv << lc), lc + hc) for hv, hc in small for lv, lc in small]
+
+
+_SSG_TABLE = _ssg_table()
+_MASK64 = (1 << 64) - 1
+
+
+class GrainState(object):
+    ''' Checkpointable state of `GrainSSG`.
+
+        `lfsr` holds the last 80 bits of the LFSR sequence (the oldest bit is
+        the least significant one), `steps` is the number of LFSR steps taken
+        so far and `pending` holds `npending` output bits that were generated
+        but not yet consumed. `position` is the number of output bits consumed
+        so far.
+    '''
+    def __init__(self, lfsr, steps, pending=0, npending=0, position=0):
+        self.lfsr = lfsr
+        self.steps = steps
+        self.pending = pending
+        self.npending = npending
+        self.position = position
+
+    def __eq__(self, other):
+        return isinstance(other, GrainState) and \
+            (self.lfsr, self.steps, self.pending, self.npending, self.position) == \
+            (other.lfsr, other.steps, other.pending, other.npending, other.position)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class GrainSSG(object):
+    ''' The Grain LSFR in a self-shrinking generator producing many bits at once.
+
+        The feedback taps of the LFSR are at least 18 positions apart, hence 16
+        new LFSR bits are computed with one set of shifts on an 80 bit integer.
+        The self-shrinking step is done with a table lookup on these 8 pairs.
+    '''
+    def __init__(self, state=None):
+        if state is None:
+            state = GrainState((1 << 80) - 1, 0)
+            # Discard first 160 bits
+            for _ in range(160 // 16):
+                state.lfsr = self._step(state.lfsr)[0]
+            state.steps = 160
+        self.setstate(state)
+
+    @staticmethod
+    def _step(lfsr):
+        bits = (lfsr ^ (lfsr >> 13) ^ (lfsr >> 23) ^ (lfsr >> 38) ^ (lfsr >> 51) ^ (lfsr >> 62)) & 0xffff
+        return (lfsr >> 16) | (bits << 64), bits
+
+    def getstate(self):
+        ''' Return the current state which can be restored with `setstate`. '''
+        return GrainState(self._lfsr, self._steps, self._pending, self._npending, self._position)
+
+    def setstate(self, state):
+        self._lfsr = state.lfsr
+        self._steps = state.steps
+        self._pending = state.pending
+        self._npending = state.npending
+        self._position = state.position
+
+    @property
+    def position(self):
+        ''' Number of output bits consumed so far. '''
+        return self._position
+
+    def _generate(self, count):
+        ''' Generate at least `count` new output bits and append them to the
+            pending bits.
+        '''
+        table = _SSG_TABLE
+        lfsr = self._lfsr
+        words = []
+        acc, nacc = 0, 0
+        steps = 0
+        produced = 0
+        while produced < count:
+            bits = (lfsr ^ (lfsr >> 13) ^ (lfsr >> 23) ^ (lfsr >> 38) ^ (lfsr >> 51) ^ (lfsr >> 62)) & 0xffff
+            lfsr = (lfsr >> 16) | (bits << 64)
+            value, length = table[bits]
+            acc |= value << nacc
+            nacc += length
+            produced += length
+            if nacc >= 64:
+                words.append(acc & _MASK64)
+                acc >>= 64
+                nacc -= 64
+            steps += 1
+
+        if words:
+            acc = (acc << (64 * len(words))) | \
+                int(''.join('{:016x}'.format(w) for w in reversed(words)), 16)
+        self._lfsr = lfsr
+        self._steps += 16 * steps
+        self._pending |= acc << self._npending
+        self._npending += produced
+
+    def bits(self, count):
+        ''' Return the next `count` bits packed into an integer, the first bit
+            is the least significant one.
+        '''
+        if self._npending < count:
+            with PROFILE.phase('grain'):
+                self._generate(count - self._npending)
+        value = self._pending & ((1 << count) - 1)
+        self._pending >>= count
+        self._npending -= count
+        self._position += count
+        return value
+
+    def words(self, count):
+        ''' Return the next `64 * count` bits as list of 64 bit words. '''
+        digits = '{:0{}x}'.format(self.bits(64 * count), 16 * count)
+        return [int(digits[i - 16:i], 16) for i in range(16 * count, 0, -16)]
+
+    def bytes(self, count):
+        ''' Return the next `8 * count` bits as little endian byte buffer. '''
+        digits = '{:0{}x}'.format(self.bits(8 * count), 2 * count)
+        return bytes(bytearray(int(digits[i - 2:i], 16) for i in range(2 * count, 0, -2)))
+
+    def skip(self, count):
+        ''' Discard the next `count` bits. '''
+        while count:
+            chunk = min(count, 1 << 16)
+            self.bits(chunk)
+            count -= chunk
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.bits(1)
+
+    next = __next__
 
 
 def grain_ssg():
     ''' A generator for using the Grain LSFR in a self-shrinking generator. '''
-    state = [1] * 80
-    index = 0
-    # Discard first 160 bits
-    for _ in range(160):
-        state[index] ^= state[(index + 13) % 80] ^ state[(index + 23) % 80]\
-                        ^ state[(index + 38) % 80] ^ state[(index + 51) % 80]\
-                        ^ state[(index + 62) % 80]
-        index += 1
-        index %= 80
-    choice = False
-    while True:
-        state[index] ^= state[(index + 13) % 80] ^ state[(index + 23) % 80]\
-                        ^ state[(index + 38) % 80] ^ state[(index + 51) % 80]\
-                        ^ state[(index + 62) % 80]
-        choice = state[index]
-        index += 1
-        index %= 80
-        state[index] ^= state[(index + 13) % 80] ^ state[(index + 23) % 80]\
-                        ^ state[(index + 38) % 80] ^ state[(index + 51) % 80]\
-                        ^ state[(index + 62) % 80]
-        if choice == 1:
-            yield state[index]
-        index += 1
-        index %= 80
+    return GrainSSG()
 
 
 if __name__ == '__main__':
     import sys
 
-    if len(sys.argv) == 4:
-        blocksize, keysize, rounds = map(int, sys.argv[1:4])
-        main(blocksize, keysize, rounds)
-    else:
-        main()
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    params = tuple(map(int, args)) if len(args) == 3 else (256, 256, 19)
+    # --jobs=N uses N worker processes, --jobs one per CPU (the default for --verify)
+    processes = None if '--verify' in flags else 1
+    for flag in flags:
+        if flag == '--jobs':
+            processes = None
+        elif flag.startswith('--jobs='):
+            processes = int(flag[len('--jobs='):])
+
+    if '--verify' in flags:
+        # check an existing instance against its checkpoints
+        mismatches = verify(*params, processes=processes)
+        for section, i in mismatches:
+            print('{}_{} differs'.format(section, i))
+        sys.exit(1 if mismatches else 0)
+
+    report = profile_filename(flags, 'profile_generate_{}_{}_{}.json'.format(*params))
+    PROFILE.enabled = report is not None
+    main(*params, processes=processes)
+    if report is not None:
+        PROFILE.write(report)
@@ -0,0 +1,533 @@
+"""
+GF(2) linear algebra on rows packed into Python integers
+
+Besides the incremental Gaussian elimination, this module provides a subset of Sage's matrix and
+vector interface that is sufficient for the scripts in this repository.
+"""
+
+from copy import copy
+import random
+import sys
+
+from profiling import PROFILE
+
+
+class Eliminator(object):
+    """
+    incremental Gaussian elimination over GF(2) with rows packed into integers
+
+    Bit j of a row is the entry in column j. Rows are reduced against the basis as they are added.
+    The independent rows are numbered in the order they are added and every basis row keeps track
+    of the combination of independent rows it was derived from. This allows to express dependent
+    rows in terms of the independent ones and to compute the inverse without another elimination.
+    """
+
+    def __init__(self, ncols, track=True):
+        self.ncols = ncols
+        self.track = track
+        self.rank = 0
+        # pivot -> (reduced row, combination of independent rows)
+        self.basis = {}
+
+    def add(self, row):
+        """
+        add a row and return a tuple (independent, combination), where combination describes
+        the row in terms of the independent rows (if tracking is enabled)
+        """
+        basis = self.basis
+        combination = 0
+        while row:
+            pivot = row.bit_length() - 1
+            entry = basis.get(pivot)
+            if entry is None:
+                position = 1 << self.rank
+                basis[pivot] = (row, combination ^ position)
+                self.rank += 1
+                return True, position
+            row ^= entry[0]
+            if self.track:
+                combination ^= entry[1]
+        return False, combination
+
+    def inverse(self):
+        """
+        return the rows of the inverse of the matrix formed by the independent rows
+        """
+        if not self.track:
+            raise ValueError("Combinations were not tracked")
+        if self.rank != self.ncols:
+            raise ValueError("Matrix is not invertible")
+        PROFILE.count("inversions")
+
+        # Back substitution: with increasing pivots, all lower pivots already reduce to unit rows.
+        inv = [0] * self.ncols
+        for pivot in sorted(self.basis):
+            row, combination = self.basis[pivot]
+            row ^= 1 << pivot
+            while row:
+                lower = row.bit_length() - 1
+                combination ^= inv[lower]
+                row ^= 1 << lower
+            inv[pivot] = combination
+        return inv
+
+
+if hasattr(int, "bit_count"):
+    def parity(x):
+        return x.bit_count() & 1
+else:
+    def parity(x):
+        return bin(x).count("1") & 1
+
+
+def _indices(key, length):
+    if isinstance(key, slice):
+        start, stop, step = key.indices(length)
+        if step != 1:
+            raise IndexError("only contiguous slices are supported")
+        return start, max(start, stop), True
+    if key < 0:
+        key += length
+    if not 0 <= key < length:
+        raise IndexError("index out of range")
+    return key, key + 1, False
+
+
+def _reverse(x, length):
+    if not length:
+        return 0
+    return int("{:0{}b}".format(x, length)[::-1], 2)
+
+
+class Field(object):
+    """
+    the field GF(2), elements are represented as the integers 0 and 1
+    """
+
+    def __call__(self, x):
+        return int(x) & 1
+
+    def __repr__(self):
+        return "Finite Field of size 2"
+
+
+_F = Field()
+
+
+def GF(q):
+    if q != 2:
+        raise ValueError("only GF(2) is supported")
+    return _F
+
+
+class Vector(object):
+    """
+    vector over GF(2) packed into an integer, where bit i is entry i
+    """
+
+    __slots__ = ("_value", "_length")
+
+    def __init__(self, length, value=0):
+        self._length = length
+        self._value = value
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        value = self._value
+        for i in range(self._length):
+            yield (value >> i) & 1
+
+    def list(self):
+        return list(self)
+
+    def packed(self):
+        return self._value
+
+    def mirror(self):
+        """
+        reverse the entries, i.e., P * v for the anti-diagonal matrix P
+        """
+        return Vector(self._length, _reverse(self._value, self._length))
+
+    def __getitem__(self, key):
+        start, stop, is_slice = _indices(key, self._length)
+        if not is_slice:
+            return (self._value >> start) & 1
+        return Vector(stop - start, (self._value >> start) & ((1 << (stop - start)) - 1))
+
+    def __setitem__(self, key, value):
+        start, stop, is_slice = _indices(key, self._length)
+        if isinstance(value, Vector):
+            if len(value) != stop - start:
+                raise ValueError("length mismatch")
+            bits = value._value
+        elif is_slice:
+            value = list(value)
+            if len(value) != stop - start:
+                raise ValueError("length mismatch")
+            bits = 0
+            for i, x in enumerate(value):
+                bits |= (int(x) & 1) << i
+        else:
+            bits = int(value) & 1
+        mask = ((1 << (stop - start)) - 1) << start
+        self._value = (self._value & ~mask) | (bits << start)
+
+    def __add__(self, other):
+        if not isinstance(other, Vector):
+            return NotImplemented
+        if self._length != other._length:
+            raise TypeError("vectors of different length")
+        return Vector(self._length, self._value ^ other._value)
+
+    __sub__ = __add__
+
+    def __mul__(self, other):
+        if not isinstance(other, Matrix):
+            return NotImplemented
+        if self._length != other._nrows:
+            raise TypeError("dimension mismatch")
+        result = 0
+        value = self._value
+        rows = other._rows
+        while value:
+            low = value & -value
+            result ^= rows[low.bit_length() - 1]
+            value ^= low
+        return Vector(other._ncols, result)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector) and self._length == other._length and \
+            self._value == other._value
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __copy__(self):
+        return Vector(self._length, self._value)
+
+    def __repr__(self):
+        return "(" + ", ".join(str(x) for x in self) + ")"
+
+
+class Matrix(object):
+    """
+    matrix over GF(2) with rows packed into integers, where bit j is the entry in column j
+    """
+
+    __slots__ = ("_rows", "_nrows", "_ncols")
+
+    def __init__(self, nrows, ncols, rows=None):
+        self._nrows = nrows
+        self._ncols = ncols
+        self._rows = list(rows) if rows is not None else [0] * nrows
+
+    @classmethod
+    def from_packed_rows(cls, rows, ncols):
+        return cls(len(rows), ncols, rows)
+
+    def packed_rows(self):
+        return list(self._rows)
+
+    def nrows(self):
+        return self._nrows
+
+    def ncols(self):
+        return self._ncols
+
+    def row(self, i):
+        return Vector(self._ncols, self._rows[i])
+
+    def rows(self):
+        return [Vector(self._ncols, row) for row in self._rows]
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def nonzero_positions(self):
+        return [(i, j) for i, row in enumerate(self._rows) for j in range(self._ncols)
+                if (row >> j) & 1]
+
+    def transpose(self):
+        if not self._nrows or not self._ncols:
+            return Matrix(self._ncols, self._nrows)
+        strings = ["{:0{}b}".format(row, self._ncols)[::-1] for row in self._rows]
+        # column j of the result has bit i set if row i has bit j set
+        return Matrix(self._ncols, self._nrows,
+                      [int("".join(col)[::-1], 2) for col in zip(*strings)])
+
+    def mirror(self):
+        """
+        reverse the rows and columns, i.e., P * M * P for the anti-diagonal matrices P
+        """
+        return Matrix(self._nrows, self._ncols,
+                      [_reverse(row, self._ncols) for row in reversed(self._rows)])
+
+    def augment(self, other):
+        if self._nrows != other._nrows:
+            raise TypeError("number of rows must be the same")
+        return Matrix(self._nrows, self._ncols + other._ncols,
+                      [a | (b << self._ncols) for a, b in zip(self._rows, other._rows)])
+
+    def rank(self):
+        PROFILE.count("rank calls")
+        eliminator = Eliminator(self._ncols, track=False)
+        for row in self._rows:
+            eliminator.add(row)
+        return eliminator.rank
+
+    def inverse(self):
+        if self._nrows != self._ncols:
+            raise ArithmeticError("self must be a square matrix")
+        eliminator = Eliminator(self._ncols)
+        for row in self._rows:
+            if not eliminator.add(row)[0]:
+                raise ZeroDivisionError("input matrix must be nonsingular")
+        return Matrix(self._nrows, self._ncols, eliminator.inverse())
+
+    def _key(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rstart, rstop, _ = _indices(key[0], self._nrows)
+        cstart, cstop, col_slice = _indices(key[1], self._ncols)
+        return rstart, rstop, cstart, cstop, col_slice
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and not isinstance(key[0], slice) and \
+                not isinstance(key[1], slice):
+            return self.row(key[0])[key[1]]
+        if not isinstance(key, tuple) and not isinstance(key, slice):
+            return self.row(key)
+        rstart, rstop, cstart, cstop, _ = self._key(key)
+        mask = (1 << (cstop - cstart)) - 1
+        return Matrix(rstop - rstart, cstop - cstart,
+                      [(row >> cstart) & mask for row in self._rows[rstart:rstop]])
+
+    def __setitem__(self, key, value):
+        rstart, rstop, cstart, cstop, _ = self._key(key)
+        if isinstance(value, Matrix):
+            if (value._nrows, value._ncols) != (rstop - rstart, cstop - cstart):
+                raise ValueError("dimension mismatch")
+            rows = value._rows
+        elif isinstance(value, Vector) and rstop - rstart == 1:
+            rows = [value._value]
+        else:
+            bit = int(value) & 1
+            if (rstop - rstart, cstop - cstart) != (1, 1):
+                raise ValueError("dimension mismatch")
+            rows = [bit]
+        mask = ~(((1 << (cstop - cstart)) - 1) << cstart)
+        for i, row in enumerate(rows):
+            self._rows[rstart + i] = (self._rows[rstart + i] & mask) | (row << cstart)
+
+    def __add__(self, other):
+        if not isinstance(other, Matrix):
+            return NotImplemented
+        if (self._nrows, self._ncols) != (other._nrows, other._ncols):
+            raise TypeError("dimension mismatch")
+        return Matrix(self._nrows, self._ncols,
+                      [a ^ b for a, b in zip(self._rows, other._rows)])
+
+    __sub__ = __add__
+
+    def __mul__(self, other):
+        if isinstance(other, Vector):
+            if self._ncols != other._length:
+                raise TypeError("dimension mismatch")
+            value = other._value
+            result = 0
+            for i, row in enumerate(self._rows):
+                result |= parity(row & value) << i
+            return Vector(self._nrows, result)
+        if not isinstance(other, Matrix):
+            return NotImplemented
+        if self._ncols != other._nrows:
+            raise TypeError("dimension mismatch")
+        PROFILE.count("matrix multiplications")
+        rows = other._rows
+        result = []
+        for value in self._rows:
+            acc = 0
+            while value:
+                low = value & -value
+                acc ^= rows[low.bit_length() - 1]
+                value ^= low
+            result.append(acc)
+        return Matrix(self._nrows, other._ncols, result)
+
+    def __eq__(self, other):
+        return isinstance(other, Matrix) and \
+            (self._nrows, self._ncols, self._rows) == (other._nrows, other._ncols, other._rows)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __copy__(self):
+        return Matrix(self._nrows, self._ncols, self._rows)
+
+    def __repr__(self):
+        return "\n".join("[" + " ".join(str(x) for x in row) + "]" for row in self.rows())
+
+
+_DIGITS = bytes(bytearray(ord("01"[i & 1]) for i in range(256)))
+
+
+def _pack(entries):
+    try:
+        digits = bytearray(entries)
+    except (TypeError, ValueError):
+        digits = bytearray(int(x) & 1 for x in entries)
+    if not digits:
+        return 0
+    return int(bytes(digits.translate(_DIGITS)[::-1]), 2)
+
+
+def matrix(field, *args):
+    """
+    construct a matrix like Sage's matrix: matrix(F, rows), matrix(F, nrows, ncols) or
+    matrix(F, nrows, ncols, entries), where entries is a list of rows or a flat list
+    """
+    if len(args) == 1:
+        rows = [list(row) for row in args[0]]
+        ncols = len(rows[0]) if rows else 0
+        return Matrix(len(rows), ncols, [_pack(row) for row in rows])
+    nrows, ncols = args[0], args[1]
+    if len(args) == 2:
+        return Matrix(nrows, ncols)
+    entries = list(args[2])
+    if entries and not hasattr(entries[0], "__iter__"):
+        entries = [entries[i * ncols:(i + 1) * ncols] for i in range(nrows)]
+    if len(entries) != nrows:
+        raise ValueError("number of rows does not match")
+    return Matrix(nrows, ncols, [_pack(row) for row in entries])
+
+
+def vector(field, entries):
+    """
+    construct a vector like Sage's vector: vector(F, entries) or vector(F, length)
+    """
+    if isinstance(entries, int):
+        return Vector(entries)
+    entries = list(entries)
+    return Vector(len(entries), _pack(entries))
+
+
+def random_vector(field, length):
+    return Vector(length, random.getrandbits(length) if length else 0)
+
+
+def bitslice(values, length):
+    """
+    transpose values packed into integers, such that bit b of the j-th result is bit j of
+    values[b], i.e., one integer per bit position with one lane per value
+    """
+    if not values:
+        return [0] * length
+    return Matrix(len(values), length, values).transpose().packed_rows()
+
+
+def unbitslice(slices, count):
+    """
+    inverse of bitslice for count values
+    """
+    if not slices:
+        return [0] * count
+    return Matrix(len(slices), count, slices).transpose().packed_rows()
+
+
+def bitsliced_vecmat(slices, rows, ncols):
+    """
+    compute v * M for all bitsliced vectors v, where M is given by its packed rows
+    """
+    result = [0] * ncols
+    for lanes, row in zip(slices, rows):
+        if not lanes:
+            continue
+        while row:
+            low = row & -row
+            result[low.bit_length() - 1] ^= lanes
+            row ^= low
+    return result
+
+
+def bitsliced_matvec(rows, slices):
+    """
+    compute M * v for all bitsliced vectors v, where M is given by its packed rows
+    """
+    result = []
+    for row in rows:
+        acc = 0
+        while row:
+            low = row & -row
+            acc ^= slices[low.bit_length() - 1]
+            row ^= low
+        result.append(acc)
+    return result
+
+
+def bitsliced_add(slices, other):
+    """
+    add the bitsliced vectors other to slices
+    """
+    return [a ^ b for a, b in zip(slices, other)]
+
+
+def bitsliced_add_constant(slices, constant, ones):
+    """
+    add the vector constant (packed into an integer) to all lanes of slices
+    """
+    result = list(slices)
+    while constant:
+        low = constant & -constant
+        result[low.bit_length() - 1] ^= ones
+        constant ^= low
+    return result
+
+
+class M4RITable(object):
+    """
+    Method of Four Russians lookup tables for v * M
+
+    The rows of M are split into chunks of k rows and all 2^k combinations of the rows of every
+    chunk are precomputed. Then v * M requires only one lookup and XOR per chunk.
+    """
+
+    def __init__(self, rows, ncols, k=8):
+        self.ncols = ncols
+        self.k = k
+        self.mask = (1 << k) - 1
+        self.tables = []
+        for base in range(0, len(rows), k):
+            chunk = rows[base:base + k]
+            table = [0] * (1 << len(chunk))
+            for idx in range(1, len(table)):
+                low = idx & -idx
+                table[idx] = table[idx ^ low] ^ chunk[low.bit_length() - 1]
+            self.tables.append(table)
+
+    @staticmethod
+    def size(nrows, ncols, k=8):
+        """
+        estimate the memory used by the tables in bytes
+        """
+        entry = sys.getsizeof((1 << ncols) - 1) + 8
+        return ((nrows + k - 1) // k) * (1 << k) * entry
+
+    def mul(self, value):
+        """
+        compute v * M for v packed into an integer
+        """
+        result = 0
+        mask, k = self.mask, self.k
+        for table in self.tables:
+            if not value:
+                break
+            result ^= table[value & mask]
+            value >>= k
+        return result
@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+
+"""
+bit-packed storage of the matrices and constants of a LowMC instance
+
+The file starts with a header holding the format version and n, k, r, followed by an index with the
+offsets of the linear layer, its inverse, the round key matrix and the round constant of every
+round (0 if absent). All rows are stored as little-endian 64 bit words, where bit j of a row is the
+entry in column j, and every matrix starts at a 64 byte boundary. Hence, the file can be mapped
+into memory and every round can be accessed without parsing the whole instance.
+
+Run this script with the pickles written by older versions of generate_matrices.py to convert
+them.
+"""
+
+import io
+import mmap
+import os
+import pickle
+import struct
+
+MAGIC = b"LOWMCINS"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIII4x")
+INDEX_ENTRY = struct.Struct("<QQQQ")
+ALIGNMENT = 64
+
+FLAG_INVERSES = 1
+
+# sections of a round in the order of the index entries
+SECTIONS = ("L", "Linv", "K", "R")
+
+
+def instance_filename(n, k, r):
+    return "matrices_and_constants_{}_{}_{}.bin".format(n, k, r)
+
+
+def rowstride(ncols):
+    """
+    number of bytes of a row with ncols columns
+    """
+    return (ncols + 63) // 64 * 8
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _layout(n, k, r, inverses):
+    """
+    compute the index, i.e., the offsets of all sections of all rounds, and the file size
+    """
+    offset = _align(HEADER.size + (r + 1) * INDEX_ENTRY.size)
+    index = [[0] * len(SECTIONS) for _ in range(r + 1)]
+    sizes = {"L": n * rowstride(n), "Linv": n * rowstride(n), "K": n * rowstride(k), "R": rowstride(n)}
+    for section, count in (("L", r), ("Linv", r if inverses else 0), ("R", r), ("K", r + 1)):
+        position = SECTIONS.index(section)
+        for i in range(count):
+            index[i][position] = offset
+            offset = _align(offset + sizes[section])
+    return index, offset
+
+
+class InstanceWriter(object):
+    """
+    write an instance matrix by matrix
+
+    The header and the index are written first and the file is extended to its final size, so
+    every matrix and constant is written to its offset as soon as it is passed to write and does
+    not have to be kept in memory. The file is written under a temporary name and renamed by
+    close; if the with block raises, the temporary file is removed instead.
+    """
+
+    def __init__(self, filename, n, k, r, inverses=True):
+        self.filename = filename
+        self.tmp = filename + ".tmp"
+        self.n = n
+        self.k = k
+        self.index, size = _layout(n, k, r, inverses)
+        self.file = io.open(self.tmp, "wb")
+        self.file.truncate(size)
+        header = [HEADER.pack(MAGIC, VERSION, n, k, r, FLAG_INVERSES if inverses else 0)]
+        header.extend(INDEX_ENTRY.pack(*entry) for entry in self.index)
+        self.file.write(b"".join(header))
+
+    def write(self, section, i, rows):
+        """
+        write the packed rows of section ("L", "Linv", "K" or "R") of round i
+        """
+        offset = self.index[i][SECTIONS.index(section)]
+        if not offset:
+            raise KeyError("Instance has no {} for round {}".format(section, i))
+        stride = rowstride(self.k if section == "K" else self.n)
+        self.file.seek(offset)
+        self.file.write(b"".join(row.to_bytes(stride, "little") for row in rows))
+
+    def close(self):
+        self.file.close()
+        os.rename(self.tmp, self.filename)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_instance(filename, n, k, r, L, K, R, Linv=None):
+    """
+    write an instance given by the packed rows of the matrices L, K (and Linv) and the packed
+    constants R
+    """
+    with InstanceWriter(filename, n, k, r, Linv is not None) as writer:
+        for i in range(r):
+            writer.write("L", i, L[i])
+            if Linv is not None:
+                writer.write("Linv", i, Linv[i])
+            writer.write("R", i, [R[i]])
+        for i in range(r + 1):
+            writer.write("K", i, K[i])
+
+
+class InstanceFile(object):
+    """
+    read-only view of an instance file
+
+    The file is memory-mapped; rows are only read when a round is accessed.
+    """
+
+    def __init__(self, filename):
+        with io.open(filename, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.n, self.k, self.r, flags = HEADER.unpack_from(self.data, 0)
+            if magic != MAGIC:
+                raise ValueError("{} is not a LowMC instance".format(filename))
+            if version != VERSION:
+                raise ValueError("Unsupported instance format version {}".format(version))
+            self.has_inverses = bool(flags & FLAG_INVERSES)
+            self.index = [
+                INDEX_ENTRY.unpack_from(self.data, HEADER.size + i * INDEX_ENTRY.size)
+                for i in range(self.r + 1)
+            ]
+        except (ValueError, struct.error):
+            self.data.close()
+            raise
+
+    def _section(self, section, i):
+        offset = self.index[i][SECTIONS.index(section)]
+        if not offset:
+            raise KeyError("Instance has no {} for round {}".format(section, i))
+        ncols = self.k if section == "K" else self.n
+        nrows = 1 if section == "R" else self.n
+        return offset, nrows, rowstride(ncols)
+
+    def view(self, section, i):
+        """
+        memoryview of the rows of section ("L", "Linv", "K" or "R") of round i without copying them
+
+        The view has to be released before the file is closed.
+        """
+        offset, nrows, stride = self._section(section, i)
+        return memoryview(self.data)[offset:offset + nrows * stride]
+
+    def rows(self, section, i):
+        """
+        packed rows of section ("L", "Linv", "K" or "R") of round i
+        """
+        offset, nrows, stride = self._section(section, i)
+        data = self.data
+        return [
+            int.from_bytes(data[o:o + stride], "little")
+            for o in range(offset, offset + nrows * stride, stride)
+        ]
+
+    def constant(self, i):
+        """
+        packed round constant of round i
+        """
+        return self.rows("R", i)[0]
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_instance(n, k, r):
+    """
+    open the instance file of the given parameters and check its header
+    """
+    inst = InstanceFile(instance_filename(n, k, r))
+    if inst.n != n or inst.k != k or inst.r != r:
+        inst.close()
+        raise ValueError("Unexpected LowMC instance.")
+    return inst
+
+
+class _InstanceUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        # generate_matrices.py pickled Instance as __main__.Instance when run as a script
+        if name == "Instance":
+            from generate_matrices import Instance
+
+            return Instance
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+def convert_pickle(pickle_filename, filename=None):
+    """
+    convert an Instance pickle with matrices stored as lists of bits
+    """
+    with io.open(pickle_filename, "rb") as f:
+        inst = _InstanceUnpickler(f).load()
+
+    def pack(bits):
+        return sum(bit << j for j, bit in enumerate(bits))
+
+    def pack_matrix(mat):
+        return [pack(row) for row in mat]
+
+    Linv = getattr(inst, "Linv", None)
+    if filename is None:
+        filename = instance_filename(inst.n, inst.k, inst.r)
+    write_instance(
+        filename, inst.n, inst.k, inst.r,
+        [pack_matrix(m) for m in inst.L],
+        [pack_matrix(m) for m in inst.K],
+        [pack(c) for c in inst.R],
+        [pack_matrix(m) for m in Linv] if Linv is not None else None,
+    )
+    return filename
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("usage: {} matrices_and_constants_n_k_r.pickle ...".format(sys.argv[0]))
+        sys.exit(1)
+    for pickle_filename in sys.argv[1:]:
+        print("{} -> {}".format(pickle_filename, convert_pickle(pickle_filename)))
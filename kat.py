@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+
+"""
+Generate and verify known-answer tests of the LowMC instances.
+
+The records of an instance are stored in kat_n_k_r.bin: a header with the format version, n, k, r,
+the number of S-boxes and the number of records, followed by the records. Every record consists of
+the key, the plaintext and the ciphertext as little-endian packed bits, i.e., bit j is entry j of
+the vector, each padded to full bytes.
+
+With --generate, random keys and plaintexts are encrypted with LowMC.enc_batch in chunks that are
+distributed over a pool of worker processes, and the records are written as the chunks complete.
+Otherwise, the files are read chunk by chunk and every record is checked against every
+encryption variant of LowMC (or the ones given by --variant), again in the worker processes.
+Only a few chunks are in flight at a time, so the memory usage does not depend on the size of the
+files.
+"""
+
+from __future__ import print_function
+
+import collections
+import io
+import multiprocessing
+import os
+import random
+import struct
+import sys
+
+from backend import pack_vector, unpack_vector
+from build_all import PARAMETER_SETS
+from lowmc import LowMC
+
+MAGIC = b"LOWMCKAT"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIIQ")
+
+VARIANTS = (
+    "enc", "enc_transposed", "enc_rrkc", "enc_rrkc_rll", "enc_rrkc_rll_int",
+    "enc_batch", "enc_transposed_batch", "enc_rrkc_batch", "enc_rrkc_rll_batch",
+)
+
+
+def kat_filename(n, k, r):
+    return "kat_{}_{}_{}.bin".format(n, k, r)
+
+
+def record_sizes(n, k):
+    """
+    number of bytes of the key and of the plaintext and ciphertext of a record
+    """
+    return (k + 7) // 8, (n + 7) // 8
+
+
+def pack_records(n, k, records):
+    key_bytes, block_bytes = record_sizes(n, k)
+    return b"".join(
+        key.to_bytes(key_bytes, "little") + plaintext.to_bytes(block_bytes, "little")
+        + ciphertext.to_bytes(block_bytes, "little")
+        for key, plaintext, ciphertext in records
+    )
+
+
+def unpack_records(n, k, data):
+    key_bytes, block_bytes = record_sizes(n, k)
+    size = key_bytes + 2 * block_bytes
+    records = []
+    for offset in range(0, len(data), size):
+        key = int.from_bytes(data[offset:offset + key_bytes], "little")
+        offset += key_bytes
+        plaintext = int.from_bytes(data[offset:offset + block_bytes], "little")
+        offset += block_bytes
+        ciphertext = int.from_bytes(data[offset:offset + block_bytes], "little")
+        records.append((key, plaintext, ciphertext))
+    return records
+
+
+_instances = {}
+
+
+def _lowmc(params):
+    """
+    LowMC instance of the worker process, created on first use
+    """
+    if params not in _instances:
+        n, k, r, s = params
+        _instances[params] = LowMC(n, k, s, r)
+    return _instances[params]
+
+
+def _encrypt(args):
+    params, keys, plaintexts = args
+    ciphertexts = _lowmc(params).enc_batch(keys, plaintexts)
+    return list(zip(keys, plaintexts, ciphertexts))
+
+
+def _check(args):
+    """
+    check the records of a chunk against the variants, return the indices of the records and the
+    variants that differ
+    """
+    params, variants, first, data = args
+    n, k, r, s = params
+    lowmc = _lowmc(params)
+    records = unpack_records(n, k, data)
+    keys = [key for key, _, _ in records]
+    plaintexts = [plaintext for _, plaintext, _ in records]
+    mismatches = []
+    for variant in variants:
+        enc = getattr(lowmc, variant)
+        if variant.endswith("_batch"):
+            ciphertexts = enc(keys, plaintexts)
+        else:
+            ciphertexts = [
+                pack_vector(enc(unpack_vector(key, k), unpack_vector(plaintext, n)))
+                for key, plaintext in zip(keys, plaintexts)
+            ]
+        mismatches.extend(
+            (first + i, variant) for i, (record, ciphertext) in enumerate(zip(records, ciphertexts))
+            if record[2] != ciphertext
+        )
+    return mismatches
+
+
+def _bounded(pool, function, jobs, window):
+    """
+    apply function to the jobs in pool, keeping at most window of them in flight, and yield the
+    results in order
+    """
+    pending = collections.deque()
+    for job in jobs:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (job,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def generate(params, count, chunk, pool, window, seed=0):
+    """
+    write count records of random keys and plaintexts of the instance, return the file name
+    """
+    n, k, r, s = params
+    rng = random.Random(seed)
+
+    def jobs():
+        for start in range(0, count, chunk):
+            size = min(chunk, count - start)
+            keys = [rng.getrandbits(k) for _ in range(size)]
+            plaintexts = [rng.getrandbits(n) for _ in range(size)]
+            yield params, keys, plaintexts
+
+    filename = kat_filename(n, k, r)
+    tmp = filename + ".tmp"
+    with io.open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, n, k, r, s, count))
+        for records in _bounded(pool, _encrypt, jobs(), window):
+            f.write(pack_records(n, k, records))
+    os.rename(tmp, filename)
+    return filename
+
+
+def verify(params, variants, chunk, pool, window):
+    """
+    check the records of the instance against the variants, return the number of records and
+    the list of mismatches
+    """
+    n, k, r, s = params
+    key_bytes, block_bytes = record_sizes(n, k)
+    size = key_bytes + 2 * block_bytes
+    with io.open(kat_filename(n, k, r), "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise ValueError("{} is truncated".format(kat_filename(n, k, r)))
+        magic, version, n_, k_, r_, s_, count = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("{} is not a LowMC KAT file".format(kat_filename(n, k, r)))
+        if version != VERSION:
+            raise ValueError("Unsupported KAT format version {}".format(version))
+        if (n_, k_, r_, s_) != (n, k, r, s):
+            raise ValueError("Unexpected LowMC instance.")
+
+        def jobs():
+            for first in range(0, count, chunk):
+                data = f.read(min(chunk, count - first) * size)
+                if len(data) != min(chunk, count - first) * size:
+                    raise ValueError("{} is truncated".format(kat_filename(n, k, r)))
+                yield params, variants, first, data
+
+        mismatches = []
+        for result in _bounded(pool, _check, jobs(), window):
+            mismatches.extend(result)
+    return count, mismatches
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("instances", nargs="*", metavar="n,k,r,s",
+                        help="parameters of the instances (default: all instances)")
+    parser.add_argument("--generate", action="store_true",
+                        help="generate the KAT files instead of verifying them")
+    parser.add_argument("--count", type=int, default=1024,
+                        help="number of records per instance to generate")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the random keys and plaintexts")
+    parser.add_argument("--chunk", type=int, default=1024, help="number of records per job")
+    parser.add_argument("--variant", action="append", choices=VARIANTS,
+                        help="variants to verify (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    parameter_sets = [tuple(map(int, p.split(","))) for p in args.instances] or PARAMETER_SETS
+    pool = multiprocessing.Pool(args.jobs)
+    # keep the workers busy without reading whole files
+    window = 2 * (args.jobs or multiprocessing.cpu_count())
+    failed = False
+    try:
+        for params in parameter_sets:
+            name = "lowmc_{}_{}_{}".format(*params[:3])
+            if args.generate:
+                filename = generate(params, args.count, args.chunk, pool, window, args.seed)
+                print("{}: {} records written to {}".format(name, args.count, filename))
+                continue
+            try:
+                count, mismatches = verify(params, args.variant or VARIANTS, args.chunk, pool,
+                                           window)
+            except (IOError, ValueError) as e:
+                print("{}: {}".format(name, e))
+                failed = True
+                continue
+            for index, variant in mismatches[:10]:
+                print("{}: record {} differs for {}".format(name, index, variant))
+            if mismatches:
+                print("{}: {} mismatches in {} records".format(name, len(mismatches), count))
+                failed = True
+            else:
+                print("{}: {} records OK".format(name, count))
+    finally:
+        pool.close()
+        pool.join()
+    sys.exit(1 if failed else 0)
@@ -1,11 +1,17 @@
-from sage.all import matrix, vector, GF, random_matrix, random_vector, copy, timeit
+from backend import F, matrix, vector, random_vector, mirror, pack_rows, unpack_rows, pack_vector, \
+    unpack_vector
 
 # from process_matrices import print_mzd
-from generate_matrices import Instance
+from instance_file import instance_filename, open_instance
+from build_all import PARAMETER_SETS
 from process_matrices import print_vector
-import pickle, io
-
-F = GF(2)
+from precomputations import compute_rrkc, compute_rll
+from cache import PrecomputationCache, instance_digest
+from gf2 import M4RITable, parity, bitslice, unbitslice, bitsliced_vecmat, bitsliced_matvec, bitsliced_add, \
+    bitsliced_add_constant
+import os
+import random
+import time
 
 def state_to_byte_array(s):
     a = []
@@ -17,7 +23,7 @@ def state_to_byte_array(s):
     return a
 
 def print_hex_state(s):
-    print "".join([hex(x)[2:].zfill(2).upper() for x in state_to_byte_array(s)])
+    print("".join([hex(x)[2:].zfill(2).upper() for x in state_to_byte_array(s)]))
 
 
 def S(a, b, c):
@@ -29,163 +35,308 @@ def print_mzd(w, do_reverse=False):
     else:
         print("".join(str(x) for x in w))
 
-def calc_dot_from_full_rank(mat):
+
+class _Rounds(object):
     """
-    calculate the matrix \dot{M} from M, where M is M^1*
-    in our implementation, M is horizontally and vertically mirrored and transposed
+    sequence of per-round matrices or vectors built on first access
+    """
+    def __init__(self, count, build):
+        self.items = [None] * count
+        self.build = build
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self.items)))]
+        item = self.items[i]
+        if item is None:
+            item = self.items[i] = self.build(i % len(self.items))
+        return item
+
+    def __iter__(self):
+        for i in range(len(self.items)):
+            yield self[i]
+
+
+class ExpandedKey(object):
     """
-    dot_size = mat.ncols()
-    M_dot = matrix(F, dot_size, dot_size)
-    current_rank = 0
-    idx = 0
-    indices = []
-    while current_rank < dot_size:
-        assert idx < mat.nrows(), "mat should have full rank, something is wrong"
-        M_dot[current_rank,:] = mat[idx,:]
-        if current_rank == M_dot.rank():
-            indices.append(idx)
-        current_rank = M_dot.rank()
-        idx += 1
+    round key material of a key, computed on first use and shared by all encryptions with the key
 
-    return M_dot, indices
+    Returned by LowMC.expand_key and accepted by the enc variants of LowMC instead of the key. The
+    batch variants only take the key from it, as they compute the key material of all lanes at
+    once.
+    """
+    def __init__(self, lowmc, sk):
+        self.lowmc = lowmc
+        self.sk = sk
+        self._round_keys = None
+        self._linear = None
+        self._nl = None
+        self._packed_int = None
+
+    @property
+    def round_keys(self):
+        """
+        round keys K[i] * sk of the rounds 0, ..., r
+        """
+        if self._round_keys is None:
+            lowmc = self.lowmc
+            self._round_keys = [lowmc._vecmat(self.sk, ('Kt', i), lambda: lowmc.Kt[i])
+                                for i in range(lowmc.r + 1)]
+        return self._round_keys
+
+    def _expand_rrkc(self):
+        lowmc = self.lowmc
+        if not lowmc.rrkc_precomputations_done:
+            lowmc.rrkc_precomputations()
+        self._linear = self.sk * lowmc.round_key_matrix_linear
+        self._nl = self.sk * lowmc.precomputed_key_matrix_nl + lowmc.precomputed_constant_nl
+
+    @property
+    def linear(self):
+        """
+        linear part of the reduced round keys, added before the first round
+        """
+        if self._linear is None:
+            self._expand_rrkc()
+        return self._linear
+
+    @property
+    def nl(self):
+        """
+        non-linear parts of the reduced round keys of all rounds, including the constants
+        """
+        if self._nl is None:
+            self._expand_rrkc()
+        return self._nl
+
+    @property
+    def packed_int(self):
+        """
+        non-linear parts of the reduced round keys including the constants and the linear part of
+        the reduced round keys as packed integers, as used by enc_rrkc_rll_int
+        """
+        if self._packed_int is None:
+            key_nl, constant_nl, key = self.lowmc._packed('int', self.lowmc._packed_int)[:3]
+            sk = self.sk if isinstance(self.sk, int) else pack_vector(self.sk)
+            self._packed_int = key_nl.mul(sk) ^ constant_nl, key.mul(sk)
+        return self._packed_int
+
+
+class BoundPlaintext(object):
+    """
+    plaintext with the constants folded in, shared by all encryptions of the plaintext
 
+    Returned by LowMC.bind_plaintext and accepted by the enc variants of LowMC instead of the
+    plaintext. The batch variants only take the plaintext from it.
+    """
+    def __init__(self, lowmc, p):
+        self.lowmc = lowmc
+        self.p = p
+        self._rrkc = None
+        self._packed_int = None
+
+    @property
+    def rrkc(self):
+        """
+        plaintext with the linear part of the reduced round constants added
+        """
+        if self._rrkc is None:
+            lowmc = self.lowmc
+            if not lowmc.rrkc_precomputations_done:
+                lowmc.rrkc_precomputations()
+            self._rrkc = self.p + lowmc.precomputed_constant
+        return self._rrkc
+
+    @property
+    def packed_int(self):
+        """
+        packed plaintext with the linear part of the reduced round constants added, as used by
+        enc_rrkc_rll_int
+        """
+        if self._packed_int is None:
+            constant = self.lowmc._packed('int', self.lowmc._packed_int)[3]
+            p = self.p if isinstance(self.p, int) else pack_vector(self.p)
+            self._packed_int = p ^ constant
+        return self._packed_int
 
 
 class LowMC(object):
-    def __init__(self, n, k, s, r):
+    def __init__(self, n, k, s, r, m4ri=False, m4ri_memory=128 * 1024 * 1024, m4ri_k=8,
+                 cache=None):
+        """
+        The RRKC and RLL precomputations are loaded from (and stored in) cache, by default the
+        PrecomputationCache configured by LOWMC_CACHE_DIR.
+
+        If m4ri is set, enc_transposed and enc_rrkc_rll evaluate the products with Lt[i], Kt[i],
+        R_wedge[i] and T_vee[i] using M4RI tables with chunks of m4ri_k rows. Tables are
+        built on first use as long as their total size stays below m4ri_memory bytes.
+        """
         self.n = n
         self.k = k
         self.s = s
         self.r = r
 
-        with io.open('matrices_and_constants_{}_{}_{}.pickle'.format(n, k, r), 'rb') as matfile:
-            inst = pickle.load(matfile)
-
-        if inst.n != n or inst.k != k or inst.r != r:
-            raise ValueError("Unexpected LowMC instance.")
-
-        P = matrix(F, n, n)
-        for i in range(n):
-            P[n - i - 1, i] = 1
-
-        self.L = [P * matrix(F, L) * P for L in inst.L]
-        self.K = [P * matrix(F, K) * P for K in inst.K]
-        self.C = [P * vector(F, R) for R in inst.R]
-
-        self.Lt = [L.transpose() for L in self.L]
-        self.Kt = [K.transpose() for K in self.K]
+        self.cache = cache if cache is not None else PrecomputationCache()
+        self.instance = open_instance(n, k, r)
+        self._digest = None
+
+        # the round matrices are read from the instance file on first access, every
+        # representation is derived directly from the packed rows
+        self.L = _Rounds(r, lambda i: self._matrix('L', i, n))
+        self.K = _Rounds(r + 1, lambda i: self._matrix('K', i, k))
+        self.C = _Rounds(r, lambda i: mirror(unpack_vector(self.instance.constant(i), n)))
+        self.Lt = _Rounds(r, lambda i: self._matrix('L', i, n).transpose())
+        self.Kt = _Rounds(r + 1, lambda i: self._matrix('K', i, k).transpose())
+        # inverses computed during the generation of the matrices
+        self.Linv = _Rounds(r, lambda i: self._matrix('Linv', i, n)) \
+            if self.instance.has_inverses else None
 
         self.rrkc_precomputations_done = False
         self.rll_precomputations_done = False
+        # packed rows of the matrices used by the batch encryptions
+        self.packed = {}
+        # bits a of the S-boxes (a, b, c) of the state packed into an integer
+        self.packed_sbox_mask = sum(1 << (n - 3 * (i + 1)) for i in range(s))
+
+        self.m4ri = m4ri
+        self.m4ri_memory = m4ri_memory
+        self.m4ri_k = m4ri_k
+        self.m4ri_tables = {}
+        self.m4ri_table_size = 0
+
+    def _matrix(self, section, i, ncols):
+        return mirror(unpack_rows(self.instance.rows(section, i), ncols))
+
+    @property
+    def digest(self):
+        if self._digest is None and self.cache.enabled:
+            self._digest = instance_digest(self.instance)
+        return self._digest
 
     def rrkc_precomputations(self):
-        self.Li = [m.inverse() for m in self.Lt]
-        self.LiK = [self.Kt[i + 1] * self.Li[i] for i in range(self.r)]
-        self.LiC = [self.C[i] * self.Li[i] for i in range(self.r)]
-
-        mod_Li = [copy(self.Li[i]) for i in range(self.r)]
-        for j in range(self.r):
-            mod_Li[j][self.n - 3*self.s:, :self.n] = matrix(F, 3 * self.s, self.n)
+        def compute():
+            Li = [m.transpose() for m in self.Linv] if self.Linv is not None else None
+            return compute_rrkc(self.Lt, self.Kt, self.C, self.n, self.s, Li)
+
+        rrkc = self.cache.get_or_compute(self.digest, "rrkc", self.s, compute)
+        self.Li = rrkc["Li"]
+        self.LiK = rrkc["LiK"]
+        self.LiC = rrkc["LiC"]
+        self.precomputed_key_matrix = rrkc["key_linear"]
+        self.precomputed_constant = rrkc["constant_linear"]
+        # first round key matrix including the linear parts of the later rounds
+        self.round_key_matrix_linear = self.Kt[0] + self.precomputed_key_matrix
 
-        self.precomputed_key_matrix = None
         self.precomputed_key_matrix_nl = matrix(F, self.n, (self.s * 3) * self.r)
-        self.precomputed_constant = None
         self.precomputed_constant_nl = vector(F, (self.s * 3) * self.r)
-
         for round in range(self.r):
-            tmp = copy(self.LiK[round])
-            tmpC = copy(self.LiC[round])
-
-            for i in range(round + 1, self.r):
-                x = self.LiK[i]
-                c = self.LiC[i]
-                for j in range(i - 1, round - 1, -1):
-                    x = x * mod_Li[j]
-                    c = c * mod_Li[j]
-                tmp += x
-                tmpC += c
-
-            # non-linear part
             idx = round * (3 * self.s)
-            self.precomputed_key_matrix_nl[:self.n, idx:idx + 3 * self.s] = tmp[:self.n, self.n - 3*self.s:]
-            self.precomputed_constant_nl[idx:idx + 3 * self.s] = tmpC[self.n - 3 * self.s:]
-
-            # linear part
-            if round == 0:
-                tmp[:,self.n - 3*self.s:] = matrix(F, self.n, 3*self.s)
-                tmpC[self.n - 3*self.s:] = vector(F, 3*self.s)
-                self.precomputed_key_matrix = tmp
-                self.precomputed_constant = tmpC
+            self.precomputed_key_matrix_nl[:self.n, idx:idx + 3 * self.s] = rrkc["key_nl"][round]
+            self.precomputed_constant_nl[idx:idx + 3 * self.s] = rrkc["constant_nl"][round]
 
         self.rrkc_precomputations_done = True
 
     def rll_precomputations(self):
-        self.R = []
-        self.R_dot = []
-        self.R_dot_inv = []
-        self.R_wedge = []
-        self.R_cols = []
-        self.T_vee = []
-        
-        # i = 1
-        self.R.append(self.Lt[0][:, 0:self.n-3*self.s])
-        Rdot, colR = calc_dot_from_full_rank(self.R[0])
-        self.R_dot.append(Rdot)
-        self.R_cols.append(colR)
-        self.R_dot_inv.append(self.R_dot[0].inverse())
-
-        self.R_wedge.append(self.R[0]*self.R_dot_inv[0])
-
-        # i = 2...r-1
-        for i in range(1,self.r-1):
-            self.T_vee.append(self.R_dot[i-1] * self.Lt[i][0:self.n-self.s*3,:])
-            R = matrix(F, self.n, self.n-self.s*3)
-            R[0:self.n-3*self.s, :] = self.T_vee[-1][0:self.n-3*self.s, 0:self.n-3*self.s]
-            R[self.n-3*self.s:self.n, :] = self.Lt[i][self.n-3*self.s:self.n, 0:self.n-3*self.s]
-            self.R.append(R)
-            Rdot, colR = calc_dot_from_full_rank(self.R[i])
-            self.R_dot.append(Rdot)
-            self.R_cols.append(colR)
-            self.R_dot_inv.append(self.R_dot[i].inverse())
-            self.R_wedge.append(self.R[i]*self.R_dot_inv[i])
-
-        # i = r
-        self.T_vee.append(self.R_dot[self.r-2] * self.Lt[self.r-1][0:self.n-self.s*3,:])
+        rll = self.cache.get_or_compute(
+            self.digest, "rll", self.s, lambda: compute_rll(self.Lt, self.n, self.s)
+        )
+        self.R = rll["R"]
+        self.R_dot = rll["R_dot"]
+        self.R_dot_inv = rll["R_dot_inv"]
+        self.R_wedge = rll["R_wedge"]
+        self.R_cols = rll["R_cols"]
+        self.T_vee = rll["T_vee"]
+        self.Z_i = rll["Z_i"]
+        self.Z_r = rll["Z_r"]
 
         self.rll_precomputations_done = True
 
+    def _vecmat(self, v, key, build):
+        """
+        calculate v * M, where M = build(), using the M4RI table stored under key if enabled
+        """
+        if not self.m4ri:
+            return v * build()
+        if key not in self.m4ri_tables:
+            m = build()
+            size = M4RITable.size(m.nrows(), m.ncols(), self.m4ri_k)
+            if self.m4ri_table_size + size <= self.m4ri_memory:
+                self.m4ri_tables[key] = M4RITable(pack_rows(m), m.ncols(), self.m4ri_k)
+                self.m4ri_table_size += size
+            else:
+                self.m4ri_tables[key] = None
+        table = self.m4ri_tables[key]
+        if table is None:
+            return v * build()
+        return unpack_vector(table.mul(pack_vector(v)), table.ncols)
 
     def keygen(self):
         return random_vector(F, self.k)
 
+    def expand_key(self, sk):
+        """
+        expand the key sk for any number of encryptions
+
+        The result can be passed to all enc variants instead of sk. The round keys (or the reduced
+        round keys) are computed on first use and then reused.
+        """
+        return ExpandedKey(self, sk)
+
+    def bind_plaintext(self, p):
+        """
+        prepare the plaintext p for encryptions with any number of keys
+
+        The result can be passed to all enc variants instead of p.
+        """
+        return BoundPlaintext(self, p)
+
+    def _expanded(self, sk):
+        if not isinstance(sk, ExpandedKey):
+            return ExpandedKey(self, sk)
+        if sk.lowmc is not self:
+            raise ValueError("The key was expanded for another instance.")
+        return sk
+
+    def _bound(self, p):
+        if not isinstance(p, BoundPlaintext):
+            return BoundPlaintext(self, p)
+        if p.lowmc is not self:
+            raise ValueError("The plaintext was bound to another instance.")
+        return p
+
     def S(self, s):
-        for i in xrange(self.s):
+        for i in range(self.s):
             t = s[self.n - (3*(i+1)) : self.n - 3*(i)]
             s[self.n - (3*(i+1)) : self.n - 3*(i)] = S(t[0], t[1], t[2])
         return s
 
     def S_nl(self, s):
-        for i in xrange(self.s):
+        for i in range(self.s):
             t = s[self.s*3 - (3*(i+1)) : self.s*3 - 3*(i)]
             s[self.s*3 - (3*(i+1)) : self.s*3 - 3*(i)] = S(t[0], t[1], t[2])
         return s
 
     def enc(self, sk, p):
-        s = self.K[0] * sk + p
-        for i in xrange(self.r):
+        round_keys = self._expanded(sk).round_keys
+        s = round_keys[0] + self._bound(p).p
+        for i in range(self.r):
             s = self.S(s)
             s = self.L[i] * s
             s = self.C[i] + s
-            s = self.K[i + 1] * sk + s
+            s = round_keys[i + 1] + s
         return s
 
     def enc_transposed(self, sk, p):
-        s = sk * self.Kt[0] + p
-        for i in xrange(self.r):
+        round_keys = self._expanded(sk).round_keys
+        s = round_keys[0] + self._bound(p).p
+        for i in range(self.r):
             s = self.S(s)
-            s = s * self.Lt[i]
+            s = self._vecmat(s, ('Lt', i), lambda: self.Lt[i])
             s = self.C[i] + s
-            s = sk * self.Kt[i + 1] + s
+            s = round_keys[i + 1] + s
         return s
 
     def enc_rrkc(self, sk, p):
@@ -197,8 +348,9 @@ class LowMC(object):
         #---------------------------
         #ENCRYPTION
         #---------------------------
-        v = sk * self.precomputed_key_matrix_nl + self.precomputed_constant_nl
-        s = p + sk * (self.Kt[0] + self.precomputed_key_matrix) + self.precomputed_constant
+        key = self._expanded(sk)
+        v = key.nl
+        s = self._bound(p).rrkc + key.linear
 
         #calculate non-linear part
         for i in range(self.r):
@@ -220,31 +372,286 @@ class LowMC(object):
         #---------------------------
         #ENCRYPTION
         #---------------------------
-        v = sk * self.precomputed_key_matrix_nl + self.precomputed_constant_nl
-        x = p + self.precomputed_constant
-        x = x + sk * (self.Kt[0] + self.precomputed_key_matrix)
+        key = self._expanded(sk)
+        v = key.nl
+        x = self._bound(p).rrkc + key.linear
 
         # round 1
         y = self.S(x)
         y[self.n - 3*self.s:] += v[0 * (3 * self.s): (0+1) * (3 * self.s)]
-        x_0 = y * self.Lt[0][:,self.n-3*self.s:self.n]
-        z_1 = y * self.R_wedge[0]
+        x_0 = self._vecmat(y, ('Lt_nl', 0), lambda: self.Lt[0][:,self.n-3*self.s:self.n])
+        z_1 = self._vecmat(y, ('R_wedge', 0), lambda: self.R_wedge[0])
         # rounds 2..r-1
         for i in range(1,self.r-1):
             # print x_0
             y_0 = self.S_nl(x_0)
             y_0 += v[i * (3 * self.s): (i+1) * (3 * self.s)]
-            x_0 = y_0 * self.Lt[i][self.n-self.s*3:self.n, self.n-self.s*3:self.n] # L00(y_0)
-            x_0 = x_0 + z_1 * self.T_vee[i-1][0:self.n-3*self.s, self.n-3*self.s:self.n] 
-            z_1 = vector(F, z_1.list() + y_0.list()) * self.R_wedge[i]
+            x_0 = self._vecmat(y_0, ('L00', i), lambda: self.Lt[i][self.n-self.s*3:self.n, self.n-self.s*3:self.n]) # L00(y_0)
+            x_0 = x_0 + self._vecmat(z_1, ('T_vee_nl', i-1), lambda: self.T_vee[i-1][0:self.n-3*self.s, self.n-3*self.s:self.n])
+            z_1 = self._vecmat(vector(F, z_1.list() + y_0.list()), ('R_wedge', i), lambda: self.R_wedge[i])
         # round r
         y_0 = self.S_nl(x_0)
         y_0 += v[(self.r-1) * (3 * self.s): (self.r) * (3 * self.s)]
-        x_0 = y_0 * self.Lt[-1][self.n-self.s*3:self.n, :]
-        x_0 = x_0 + z_1 * self.T_vee[-1]
+        x_0 = self._vecmat(y_0, ('L0', self.r-1), lambda: self.Lt[-1][self.n-self.s*3:self.n, :])
+        x_0 = x_0 + self._vecmat(z_1, ('T_vee', self.r-2), lambda: self.T_vee[-1])
         
         return x_0
 
+    def _packed(self, name, build):
+        if name not in self.packed:
+            self.packed[name] = build()
+        return self.packed[name]
+
+    def _bitslice_inputs(self, keys, plaintexts):
+        """
+        bitslice keys and plaintexts (vectors or integers, possibly expanded or bound) and return
+        them together with the mask of all lanes and a function converting the bitsliced result
+        back
+        """
+        if len(keys) != len(plaintexts):
+            raise ValueError("Number of keys and plaintexts differ.")
+        keys = [self._expanded(sk).sk if isinstance(sk, ExpandedKey) else sk for sk in keys]
+        plaintexts = [self._bound(p).p if isinstance(p, BoundPlaintext) else p
+                      for p in plaintexts]
+        count = len(plaintexts)
+        if count and isinstance(plaintexts[0], int):
+            convert = lambda slices: unbitslice(slices, count)
+        else:
+            keys = [pack_vector(sk) for sk in keys]
+            plaintexts = [pack_vector(p) for p in plaintexts]
+            convert = lambda slices: [unpack_vector(c, len(slices))
+                                      for c in unbitslice(slices, count)]
+        return bitslice(keys, self.k), bitslice(plaintexts, self.n), (1 << count) - 1, convert
+
+    @staticmethod
+    def _S_bitsliced(s, size, sboxes):
+        """
+        apply the S-boxes to the top 3 * sboxes bits of the bitsliced state of size bits
+        """
+        for i in range(sboxes):
+            base = size - 3 * (i + 1)
+            a, b, c = s[base], s[base + 1], s[base + 2]
+            s[base] = a ^ (b & c)
+            s[base + 1] = a ^ b ^ (a & c)
+            s[base + 2] = a ^ b ^ c ^ (a & b)
+        return s
+
+    def enc_batch(self, keys, plaintexts):
+        """
+        bitsliced version of enc for many keys and plaintexts (vectors or packed integers)
+        """
+        sk, s, ones, convert = self._bitslice_inputs(keys, plaintexts)
+        L = self._packed('L', lambda: [pack_rows(m) for m in self.L])
+        K = self._packed('K', lambda: [pack_rows(m) for m in self.K])
+        C = self._packed('C', lambda: [pack_vector(c) for c in self.C])
+
+        s = bitsliced_add(bitsliced_matvec(K[0], sk), s)
+        for i in range(self.r):
+            s = self._S_bitsliced(s, self.n, self.s)
+            s = bitsliced_matvec(L[i], s)
+            s = bitsliced_add_constant(s, C[i], ones)
+            s = bitsliced_add(bitsliced_matvec(K[i + 1], sk), s)
+        return convert(s)
+
+    def enc_transposed_batch(self, keys, plaintexts):
+        """
+        bitsliced version of enc_transposed
+        """
+        sk, s, ones, convert = self._bitslice_inputs(keys, plaintexts)
+        Lt = self._packed('Lt', lambda: [pack_rows(m) for m in self.Lt])
+        Kt = self._packed('Kt', lambda: [pack_rows(m) for m in self.Kt])
+        C = self._packed('C', lambda: [pack_vector(c) for c in self.C])
+
+        s = bitsliced_add(bitsliced_vecmat(sk, Kt[0], self.n), s)
+        for i in range(self.r):
+            s = self._S_bitsliced(s, self.n, self.s)
+            s = bitsliced_vecmat(s, Lt[i], self.n)
+            s = bitsliced_add_constant(s, C[i], ones)
+            s = bitsliced_add(bitsliced_vecmat(sk, Kt[i + 1], self.n), s)
+        return convert(s)
+
+    def _packed_rrkc(self):
+        if not self.rrkc_precomputations_done:
+            self.rrkc_precomputations()
+        return self._packed('rrkc', lambda: (
+            pack_rows(self.precomputed_key_matrix_nl),
+            pack_vector(self.precomputed_constant_nl),
+            pack_rows(self.round_key_matrix_linear),
+            pack_vector(self.precomputed_constant),
+        ))
+
+    def enc_rrkc_batch(self, keys, plaintexts):
+        """
+        bitsliced version of enc_rrkc
+        """
+        sk, s, ones, convert = self._bitslice_inputs(keys, plaintexts)
+        key_nl, constant_nl, key, constant = self._packed_rrkc()
+        Lt = self._packed('Lt', lambda: [pack_rows(m) for m in self.Lt])
+        nl = 3 * self.s
+
+        v = bitsliced_add_constant(bitsliced_vecmat(sk, key_nl, nl * self.r), constant_nl, ones)
+        s = bitsliced_add(s, bitsliced_vecmat(sk, key, self.n))
+        s = bitsliced_add_constant(s, constant, ones)
+        for i in range(self.r):
+            s = self._S_bitsliced(s, self.n, self.s)
+            s[self.n - nl:] = bitsliced_add(s[self.n - nl:], v[i * nl:(i + 1) * nl])
+            s = bitsliced_vecmat(s, Lt[i], self.n)
+        return convert(s)
+
+    def _packed_rll(self):
+        if not self.rll_precomputations_done:
+            self.rll_precomputations()
+        n, nl = self.n, 3 * self.s
+        return self._packed('rll', lambda: (
+            pack_rows(self.Lt[0][:, n - nl:n]),
+            [pack_rows(m[n - nl:n, n - nl:n]) for m in self.Lt[:-1]],
+            pack_rows(self.Lt[-1][n - nl:n, :]),
+            [pack_rows(m) for m in self.R_wedge],
+            [pack_rows(m[0:n - nl, n - nl:n]) for m in self.T_vee[:-1]],
+            pack_rows(self.T_vee[-1]),
+        ))
+
+    def enc_rrkc_rll_batch(self, keys, plaintexts):
+        """
+        bitsliced version of enc_rrkc_rll
+        """
+        sk, x, ones, convert = self._bitslice_inputs(keys, plaintexts)
+        key_nl, constant_nl, key, constant = self._packed_rrkc()
+        Lt_first, L00, Lt_last, R_wedge, T_vee_nl, T_vee_last = self._packed_rll()
+        n, nl = self.n, 3 * self.s
+
+        v = bitsliced_add_constant(bitsliced_vecmat(sk, key_nl, nl * self.r), constant_nl, ones)
+        x = bitsliced_add_constant(x, constant, ones)
+        x = bitsliced_add(x, bitsliced_vecmat(sk, key, n))
+
+        # round 1
+        y = self._S_bitsliced(x, n, self.s)
+        y[n - nl:] = bitsliced_add(y[n - nl:], v[0:nl])
+        x_0 = bitsliced_vecmat(y, Lt_first, nl)
+        z_1 = bitsliced_vecmat(y, R_wedge[0], n - nl)
+        # rounds 2..r-1
+        for i in range(1, self.r - 1):
+            y_0 = self._S_bitsliced(x_0, nl, self.s)
+            y_0 = bitsliced_add(y_0, v[i * nl:(i + 1) * nl])
+            x_0 = bitsliced_add(bitsliced_vecmat(y_0, L00[i], nl),
+                                bitsliced_vecmat(z_1, T_vee_nl[i - 1], nl))
+            z_1 = bitsliced_vecmat(z_1 + y_0, R_wedge[i], n - nl)
+        # round r
+        y_0 = self._S_bitsliced(x_0, nl, self.s)
+        y_0 = bitsliced_add(y_0, v[(self.r - 1) * nl:self.r * nl])
+        x_0 = bitsliced_add(bitsliced_vecmat(y_0, Lt_last, n), bitsliced_vecmat(z_1, T_vee_last, n))
+        return convert(x_0)
+
+    def _packed_int(self):
+        """
+        tables of enc_rrkc_rll_int, built from the RRKC and RLL precomputations
+
+        For every round but the last one, the columns of Z_i (the new non-linear bits are their
+        parities with the state) and the positions and rows of R_wedge[i] of the rows not in
+        R_dot[i]. The rows of R_dot[i] form the identity, so the new linear bits are the state
+        without the bits at these positions plus the selected rows.
+        """
+        key_nl, constant_nl, key, constant = self._packed_rrkc()
+        if not self.rll_precomputations_done:
+            self.rll_precomputations()
+        n, nl = self.n, 3 * self.s
+        rounds = []
+        for i in range(self.r - 1):
+            cols = self.R_cols[i]
+            dependent = cols + list(range(n - nl + len(cols), n))
+            R_wedge = pack_rows(self.R_wedge[i])
+            rounds.append((
+                pack_rows(self.Z_i[i].transpose()),
+                [(position, R_wedge[position]) for position in dependent],
+                [(position, (1 << position) - 1) for position in sorted(dependent, reverse=True)],
+            ))
+        return (
+            M4RITable(key_nl, nl * self.r),
+            constant_nl,
+            M4RITable(key, n),
+            constant,
+            rounds,
+            M4RITable(pack_rows(self.Z_r), n),
+        )
+
+    def _S_int(self, x):
+        """
+        apply the S-boxes to the top 3 * s bits of the state packed into an integer
+        """
+        mask = self.packed_sbox_mask
+        a = x & mask
+        b = (x >> 1) & mask
+        c = (x >> 2) & mask
+        return (x & ~(mask * 7)) | a ^ (b & c) | (a ^ b ^ (a & c)) << 1 | (a ^ b ^ c ^ (a & b)) << 2
+
+    def enc_rrkc_rll_int(self, sk, p):
+        """
+        version of enc_rrkc_rll with the state packed into an integer
+
+        sk and p are vectors or packed integers (bit j is entry j), the ciphertext is returned in
+        the same form as p. Expanded keys and bound plaintexts reuse their packed round keys and
+        constants. The products with Z_i are evaluated as parities and the products with
+        R_wedge[i] by removing the bits of the rows of R_dot[i] from the state and adding the
+        remaining rows, as in the generated C code. All tables are built on the first call.
+        """
+        rounds, Z_r = self._packed('int', self._packed_int)[4:]
+        n, nl = self.n, 3 * self.s
+        linear = n - nl
+        nl_mask = (1 << nl) - 1
+        key = self._expanded(sk)
+        plaintext = self._bound(p)
+        convert = None
+        if not isinstance(plaintext.p, int):
+            convert = lambda c: unpack_vector(c, n)
+
+        v, x = key.packed_int
+        x ^= plaintext.packed_int
+        for Z, dependent, positions in rounds:
+            x = self._S_int(x) ^ (v & nl_mask) << linear
+            v >>= nl
+            y = 0
+            for j, col in enumerate(Z):
+                y |= parity(x & col) << j
+            z = 0
+            for position, row in dependent:
+                if (x >> position) & 1:
+                    z ^= row
+            for position, mask in positions:
+                x = (x & mask) | (x >> (position + 1)) << position
+            x = x ^ z | y << linear
+        x = self._S_int(x) ^ (v & nl_mask) << linear
+        c = Z_r.mul(x)
+        return convert(c) if convert is not None else c
+
+
+
+def batch_throughput(lowmc, blocks=1024):
+    """
+    measure the throughput of the batch encryptions in blocks per second
+    """
+    keys = [random.getrandbits(lowmc.k) for _ in range(blocks)]
+    plaintexts = [random.getrandbits(lowmc.n) for _ in range(blocks)]
+    result = {}
+    for name in ('enc_batch', 'enc_transposed_batch', 'enc_rrkc_batch', 'enc_rrkc_rll_batch'):
+        enc = getattr(lowmc, name)
+        # trigger the precomputations
+        enc(keys[:1], plaintexts[:1])
+        start = time.time()
+        enc(keys, plaintexts)
+        result[name] = blocks / (time.time() - start)
+    return result
+
+
+def print_batch_throughput(blocks=1024):
+    for n, k, r, s in PARAMETER_SETS:
+        try:
+            lowmc = LowMC(n, k, s, r)
+        except IOError:
+            print("lowmc_{}_{}_{}: no matrices and constants available".format(n, k, r))
+            continue
+        for name, rate in sorted(batch_throughput(lowmc, blocks).items()):
+            print("lowmc_{}_{}_{} {}: {:.0f} blocks/s".format(n, k, r, name, rate))
+
 
 def test_1():
     k = "0000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000001"
@@ -310,20 +717,89 @@ def test_5():
     p = vector(F, [int(x) for x in p])
     e = vector(F, [int(x) for x in e])
 
-    # lowmc = LowMC(128, 128, 1, 192)
-    # lowmc.rrkc_precomputations()
-    # lowmc.rll_precomputations()
-    # with io.open('tmplowmc', 'wb') as matfile:
-        # lowmc = pickle.dump(lowmc, matfile)
-    with io.open('tmplowmc', 'rb') as matfile:
-        lowmc = pickle.load(matfile)
-    # exit(1)
-    # assert lowmc.enc(k, p) == e
-    # assert lowmc.enc_transposed(k, p) == e
-    # assert lowmc.enc_rrkc(k, p) == e
+    # the instance is not part of PARAMETER_SETS, generate it on first use
+    if not os.path.exists(instance_filename(128, 128, 192)):
+        import generate_matrices
+        generate_matrices.main(128, 128, 192)
+    # the precomputations are taken from the cache after the first run
+    lowmc = LowMC(128, 128, 1, 192)
+    assert lowmc.enc(k, p) == e
+    assert lowmc.enc_transposed(k, p) == e
+    assert lowmc.enc_rrkc(k, p) == e
     assert lowmc.enc_rrkc_rll(k, p) == e
-# test_1()
-# test_2()
-# test_3()
-test_4()
-# test_5()
+    assert lowmc.enc_rrkc_rll_int(k, p) == e
+
+def test_m4ri():
+    lowmc = LowMC(128, 128, 10, 20)
+    lowmc_m4ri = LowMC(128, 128, 10, 20, m4ri=True)
+    for _ in range(10):
+        k = lowmc.keygen()
+        p = random_vector(F, lowmc.n)
+        e = lowmc.enc(k, p)
+        assert lowmc_m4ri.enc_transposed(k, p) == e
+        assert lowmc_m4ri.enc_rrkc_rll(k, p) == e
+
+def test_batch():
+    lowmc = LowMC(128, 128, 10, 20)
+    keys = [lowmc.keygen() for _ in range(50)]
+    plaintexts = [random_vector(F, lowmc.n) for _ in range(50)]
+    expected = [lowmc.enc(k, p) for k, p in zip(keys, plaintexts)]
+
+    assert lowmc.enc_batch(keys, plaintexts) == expected
+    assert lowmc.enc_transposed_batch(keys, plaintexts) == expected
+    assert lowmc.enc_rrkc_batch(keys, plaintexts) == expected
+    assert lowmc.enc_rrkc_rll_batch(keys, plaintexts) == expected
+
+def test_expanded():
+    lowmc = LowMC(128, 128, 10, 20)
+    k = lowmc.expand_key(lowmc.keygen())
+    p = lowmc.bind_plaintext(random_vector(F, lowmc.n))
+    for _ in range(5):
+        q = random_vector(F, lowmc.n)
+        e = lowmc.enc(k.sk, q)
+        assert lowmc.enc(k, q) == e
+        assert lowmc.enc_transposed(k, q) == e
+        assert lowmc.enc_rrkc(k, q) == e
+        assert lowmc.enc_rrkc_rll(k, q) == e
+
+        sk = lowmc.keygen()
+        e = lowmc.enc(sk, p.p)
+        assert lowmc.enc(sk, p) == e
+        assert lowmc.enc_rrkc(sk, p) == e
+        assert lowmc.enc_rrkc_rll(lowmc.expand_key(sk), p) == e
+        assert lowmc.enc_rrkc_rll_int(lowmc.expand_key(sk), p) == e
+        assert lowmc.enc_rrkc_rll_int(lowmc.expand_key(pack_vector(sk)),
+                                      lowmc.bind_plaintext(pack_vector(p.p))) == pack_vector(e)
+
+    keys = [lowmc.keygen() for _ in range(4)]
+    plaintexts = [random_vector(F, lowmc.n) for _ in range(4)]
+    expected = [lowmc.enc(sk, q) for sk, q in zip(keys, plaintexts)]
+    expanded = [lowmc.expand_key(sk) for sk in keys]
+    bound = [lowmc.bind_plaintext(q) for q in plaintexts]
+    for name in ('enc_batch', 'enc_transposed_batch', 'enc_rrkc_batch', 'enc_rrkc_rll_batch'):
+        assert getattr(lowmc, name)(expanded, bound) == expected
+    for sk, q, e in zip(expanded, bound, expected):
+        assert lowmc.enc_rrkc_rll_int(sk, q) == e
+        assert lowmc.enc_rrkc_rll_int(sk, q.p) == e
+
+def test_int():
+    # one and ten S-boxes, which the packed S-box layer evaluates at once
+    for lowmc in (LowMC(128, 128, 1, 182), LowMC(128, 128, 10, 20)):
+        for _ in range(10):
+            k = lowmc.keygen()
+            p = random_vector(F, lowmc.n)
+            e = lowmc.enc(k, p)
+            assert lowmc.enc_rrkc_rll_int(k, p) == e
+            assert lowmc.enc_rrkc_rll_int(pack_vector(k), pack_vector(p)) == pack_vector(e)
+
+if __name__ == "__main__":
+    # test_1()
+    # test_2()
+    # test_3()
+    test_4()
+    # test_5()
+    # test_m4ri()
+    # test_batch()
+    # test_expanded()
+    # test_int()
+    # print_batch_throughput()
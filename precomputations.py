@@ -0,0 +1,161 @@
+from backend import F, matrix, vector, copy, pack_rows, unpack_rows
+from gf2 import Eliminator
+from profiling import PROFILE
+
+
+def rrkc_precomputation(Li, LiK, LiC, n, sboxes):
+    """
+    calculate the reduced round key matrices and constants
+
+    The key and constant of round i are moved through the inverted linear layers of all
+    previous rounds. Instead of multiplying every start round with the whole chain of mod_Li,
+    the sums are accumulated from the last round backwards:
+
+      acc_r-1 = LiK[r-1],  acc_i = LiK[i] + acc_i+1 * mod_Li[i]
+
+    As the bottom 3*s rows of mod_Li are zero, only the top n - 3*s rows of Li are used.
+
+    Returns the non-linear parts of every round (n x 3*s matrices and vectors of length 3*s) and
+    the linear part of the first round (with the non-linear columns set to zero).
+    """
+    linear = n - 3 * sboxes
+    rounds = len(LiK)
+    key_nl = [None] * rounds
+    constant_nl = [None] * rounds
+
+    tmp = copy(LiK[rounds - 1])
+    tmpC = copy(LiC[rounds - 1])
+    for round in range(rounds - 1, -1, -1):
+        with PROFILE.round("rrkc", round):
+            if round != rounds - 1:
+                tmp = LiK[round] + tmp[:, :linear] * Li[round][:linear, :]
+                tmpC = LiC[round] + tmpC[:linear] * Li[round][:linear, :]
+
+            # non-linear part
+            key_nl[round] = tmp[:, linear:]
+            constant_nl[round] = tmpC[linear:]
+
+    # linear part
+    tmp[:, linear:] = matrix(F, n, 3 * sboxes)
+    tmpC[linear:] = vector(F, 3 * sboxes)
+
+    return key_nl, constant_nl, tmp, tmpC
+
+
+def calc_dot_from_full_rank(mat):
+    r"""
+    calculate the matrix \dot{M} from M, where M is M^1*
+    in our implementation, M is horizontally and vertically mirrored and transposed
+
+    \dot{M} consists of the first linearly independent rows of M. All rows are eliminated in a
+    single pass, which also expresses every row of M in terms of the rows of \dot{M}. Hence,
+    M * \dot{M}^-1 and \dot{M}^-1 are obtained without further multiplications or inversions.
+
+    Returns \dot{M}, the indices of the dependent rows skipped while selecting \dot{M}, \dot{M}^-1
+    and M * \dot{M}^-1.
+    """
+    PROFILE.count("rank calls")
+    dot_size = mat.ncols()
+    rows = pack_rows(mat)
+    eliminator = Eliminator(dot_size)
+    selected = []
+    indices = []
+    wedge = []
+    for idx, row in enumerate(rows):
+        independent, combination = eliminator.add(row)
+        if independent:
+            selected.append(row)
+        elif eliminator.rank < dot_size:
+            indices.append(idx)
+        wedge.append(combination)
+
+    if eliminator.rank < dot_size:
+        raise RuntimeError("mat should have full rank, something is wrong")
+
+    M_dot = unpack_rows(selected, dot_size)
+    M_dot_inv = unpack_rows(eliminator.inverse(), dot_size)
+    M_wedge = unpack_rows(wedge, dot_size)
+    return M_dot, indices, M_dot_inv, M_wedge
+
+
+# version of the precomputations, to be increased whenever their results change
+ALGORITHM_VERSION = 1
+
+
+def compute_rrkc(Lt, Kt, C, n, sboxes, Li=None):
+    """
+    reduced round key computation for the transposed linear layers Lt, key matrices Kt and
+    constants C
+
+    Li are the inverses of Lt, if they are already known.
+    """
+    if Li is None:
+        with PROFILE.phase("inversions"):
+            Li = [m.inverse() for m in Lt]
+    LiK = [Kt[i + 1] * Li[i] for i in range(len(Lt))]
+    LiC = [C[i] * Li[i] for i in range(len(Lt))]
+    key_nl, constant_nl, key_linear, constant_linear = rrkc_precomputation(Li, LiK, LiC, n, sboxes)
+    return {
+        "Li": Li,
+        "LiK": LiK,
+        "LiC": LiC,
+        "key_nl": key_nl,
+        "constant_nl": constant_nl,
+        "key_linear": key_linear,
+        "constant_linear": constant_linear,
+    }
+
+
+def compute_rll(Lt, n, sboxes):
+    """
+    optimized linear layer evaluation for the transposed linear layers Lt
+    """
+    rounds = len(Lt)
+    linear = n - 3 * sboxes
+    R_full = []
+    R_dot = []
+    R_cols = []
+    R_dot_inv = []
+    R_wedge = []
+    T_vee = []
+    Z_i = []
+
+    # i = 1
+    R_full.append(Lt[0][:, 0:linear])
+    Rdot, colR, Rdot_inv, Rwedge = calc_dot_from_full_rank(R_full[0])
+    R_dot.append(Rdot)
+    R_cols.append(colR)
+    R_dot_inv.append(Rdot_inv)
+    R_wedge.append(Rwedge)
+    Z_i.append(Lt[0][:, linear:n])
+
+    # i = 2...r-1
+    for i in range(1, rounds - 1):
+        with PROFILE.round("rll", i):
+            T_vee.append(R_dot[i - 1] * Lt[i][0:linear, :])
+            R = matrix(F, n, linear)
+            R[0:linear, :] = T_vee[-1][0:linear, 0:linear]
+            R[linear:n, :] = Lt[i][linear:n, 0:linear]
+            R_full.append(R)
+            Rdot, colR, Rdot_inv, Rwedge = calc_dot_from_full_rank(R_full[i])
+            R_dot.append(Rdot)
+            R_cols.append(colR)
+            R_dot_inv.append(Rdot_inv)
+            R_wedge.append(Rwedge)
+            Z_i.append(T_vee[i - 1][0:linear, linear:n].transpose().augment(
+                Lt[i][linear:n, linear:n].transpose()).transpose())
+
+    # i = r
+    T_vee.append(R_dot[rounds - 2] * Lt[rounds - 1][0:linear, :])
+    Z_r = T_vee[-1].transpose().augment(Lt[-1][linear:n, :].transpose()).transpose()
+
+    return {
+        "R": R_full,
+        "R_dot": R_dot,
+        "R_cols": R_cols,
+        "R_dot_inv": R_dot_inv,
+        "R_wedge": R_wedge,
+        "T_vee": T_vee,
+        "Z_i": Z_i,
+        "Z_r": Z_r,
+    }
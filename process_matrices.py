@@ -1,37 +1,86 @@
-#! /usr/bin/env sage
+#! /usr/bin/env python3
 
 from __future__ import unicode_literals
 
-from sage.all import GF, matrix, vector, copy
-from six.moves import range
-from generate_matrices import Instance
-import pickle, io
+from backend import F, matrix, vector, mirror, pack_rows, unpack_rows, pack_vector, unpack_vector
+from gf2 import M4RITable
+from instance_file import open_instance
+from precomputations import compute_rrkc, compute_rll
+from cache import PrecomputationCache, instance_digest
+from profiling import PROFILE, profile_filename
+import contextlib
+import io
+import json
+import os
 import sys
 import math
 
-F = GF(2)
 
+def instance_matrix(inst, section, i):
+    """
+    return the transposed matrix of section L, K or Linv of round i of the opened instance file
+    """
+    return mirror(unpack_rows(inst.rows(section, i), inst.k if section == "K" else inst.n)) \
+        .transpose()
+
+
+def instance_constant(inst, i):
+    return mirror(unpack_vector(inst.constant(i), inst.n))
 
-def calc_dot_from_full_rank(mat):
+
+def load_matrices(inst):
     """
-    calculate the matrix \dot{M} from M, where M is M^1*
-    in our implementation, M is horizontally and vertically mirrored and transposed
+    return the transposed linear layer matrices, the transposed round key matrices, the round
+    constants and the transposed inverses of the linear layers (None if the instance file does not
+    contain them) of the opened instance file
     """
-    dot_size = mat.ncols()
-    M_dot = matrix(F, dot_size, dot_size)
-    current_rank = 0
-    idx = 0
-    indices = []
-    while current_rank < dot_size:
-        if idx >= mat.nrows():
-            raise RuntimeError("mat should have full rank, something is wrong")
-        M_dot[current_rank, :] = mat[idx, :]
-        if current_rank == M_dot.rank():
-            indices.append(idx)
-        current_rank = M_dot.rank()
-        idx += 1
+    Lt = [instance_matrix(inst, "L", i) for i in range(inst.r)]
+    Kt = [instance_matrix(inst, "K", i) for i in range(inst.r + 1)]
+    Cs = [instance_constant(inst, i) for i in range(inst.r)]
+    if inst.has_inverses:
+        # inverses computed during the generation of the matrices
+        Li = [instance_matrix(inst, "Linv", i) for i in range(inst.r)]
+    else:
+        Li = None
+    return Lt, Kt, Cs, Li
+
+
+def write_instance_tables(output, tables, inst):
+    """
+    write the tables L_i, K_i and C_i of the opened instance file, one round at a time
+    """
+    output.write('#if !defined(OPTIMIZED_LINEAR_LAYER_EVALUATION)\n')
+    for i in range(inst.r):
+        tables.matrix('L_{}'.format(i), instance_matrix(inst, "L", i))
+        output.write('\n')
+    output.write('#endif\n')
+
+    output.write('#if !defined(REDUCED_ROUND_KEY_COMPUTATION)')
+    for i in range(inst.r + 1):
+        output.write('\n')
+        tables.matrix('K_{}'.format(i), instance_matrix(inst, "K", i))
+
+    for i in range(inst.r):
+        output.write('\n')
+        tables.vector('C_{}'.format(i), instance_constant(inst, i))
+    output.write('#endif\n')
+
 
-    return M_dot, indices
+@contextlib.contextmanager
+def replace_file(filename):
+    """
+    open filename.tmp for writing and rename it to filename at the end, remove it on failure
+    """
+    tmp = filename + ".tmp"
+    f = io.open(tmp, "w")
+    try:
+        yield f
+    except BaseException:
+        f.close()
+        os.remove(tmp)
+        raise
+    f.close()
+    os.rename(tmp, filename)
 
 
 def snip_r_wedge(mat_wedge, indices):
@@ -54,7 +103,9 @@ def gen_masks_from_cols(cols, num_sboxes, statesize):
     set_bits = 3 * num_sboxes
     for col in cols:
         if col < (statesize - 64):
-            raise ValueError("Invalid col")
+            raise ValueError("Invalid col {}: the optimized linear layer evaluation requires the "
+                             "columns of R to be in the last word of the state, which does not "
+                             "hold for this instance with {} S-boxes".format(col, num_sboxes))
         word |= 1 << (col % 64)
         set_bits -= 1
     for i in range(set_bits):
@@ -62,110 +113,397 @@ def gen_masks_from_cols(cols, num_sboxes, statesize):
     return word
 
 
-def combine_words(w):
-    return long("".join(reversed([str(x) for x in w])), base=2)
+class NonLinearLayout(object):
+    """
+    packing of the 3 * s non-linear key and constant bits of every round into words of width bits
+
+    If a word holds several rounds, they are packed into as many slots as fit. If that number is a
+    power of two, the word is split into equally sized lanes (e.g., two 32 bit lanes of 30 bits for
+    s = 10); otherwise the rounds are packed densely (e.g., 21 rounds of 3 bits for s = 1). In each
+    slot the bits are placed at the most significant end, so every round is loaded with a single
+    (aligned) word or lane. The bits of a round have to fit into a word, i.e., 3 * s <= width.
+    """
+
+    def __init__(self, sboxes, rounds, width=64):
+        self.sboxes = sboxes
+        self.rounds = rounds
+        self.width = width
+        self.bits = 3 * sboxes
+        if self.bits > width:
+            raise ValueError("The non-linear bits of a round (3 * s = {}) do not fit into a word "
+                             "of {} bits".format(self.bits, width))
+
+        per_word = width // self.bits
+        if per_word & (per_word - 1) == 0:
+            # power of two: one round per lane
+            self.rounds_per_slot = 1
+            self.slot_bits = width // per_word
+        else:
+            self.rounds_per_slot = per_word
+            self.slot_bits = width
+        # offset of the first round in a slot
+        self.slot_offset = self.slot_bits - self.rounds_per_slot * self.bits
+
+    @property
+    def offsets(self):
+        """
+        column of the first non-linear bit of every round
+        """
+        return [
+            (round // self.rounds_per_slot) * self.slot_bits + self.slot_offset
+            + (round % self.rounds_per_slot) * self.bits
+            for round in range(self.rounds)
+        ]
+
+    @property
+    def columns(self):
+        slots = (self.rounds + self.rounds_per_slot - 1) // self.rounds_per_slot
+        return slots * self.slot_bits
+
+    def write_defines(self, output, prefix):
+        """
+        write the parameters of the layout as preprocessor macros
+        """
+        for name, value in (
+            ("NL_BITS", self.bits),
+            ("NL_SLOT_BITS", self.slot_bits),
+            ("NL_ROUNDS_PER_SLOT", self.rounds_per_slot),
+            ("NL_SLOT_OFFSET", self.slot_offset),
+        ):
+            output.write("#define {}_{} {}\n".format(prefix, name, value))
 
 
 def uint_constant_fmtstr(width):
-    hexwidth = width / 4
+    hexwidth = width // 4
     return "UINT{}_C(0x{{:0{}x}})".format(width, hexwidth)
 
 
+def split_words(value, nwords, width=64):
+    """
+    split a packed row into nwords words of width bits, starting with the least significant one
+    """
+    mask = (1 << width) - 1
+    return [(value >> shift) & mask for shift in range(0, nwords * width, width)]
+
+
 def print_vector(output, name, typename, m, width=64):
     cols = len(m)
-    rcols = cols / width
     formatstr = uint_constant_fmtstr(width)
 
     output.write("static const {type} {name} = {{ {{".format(type=typename, name=name))
-    tmp = []
-    for b in range(0, cols, width):
-        w = m[b : b + width]
-        tmp.append(formatstr.format(combine_words(w)))
-    output.write(", ".join(tmp))
+    words = split_words(pack_vector(m), (cols + width - 1) // width, width)
+    output.write(", ".join(formatstr.format(w) for w in words))
     output.write("} };\n")
 
 
 def print_matrix(output, name, typename, m, width=64):
     rows = m.nrows()
-    cols = m.ncols()
-    rcols = cols / width
+    nwords = (m.ncols() + width - 1) // width
     formatstr = uint_constant_fmtstr(width)
 
-    output.write("static const {type} {name}".format(type=typename, name=name))
-    output.write("[{}] = {{\n".format(rows))
-    for r in m.rows():
-        output.write("  { {")
-        tmp = []
-        for b in range(0, cols, width):
-            w = r[b : b + width]
-            tmp.append(formatstr.format(combine_words(w)))
-        output.write(", ".join(tmp))
-        output.write("} },\n")
-    output.write("};\n")
+    lines = ["static const {type} {name}[{rows}] = {{\n".format(type=typename, name=name, rows=rows)]
+    for row in pack_rows(m):
+        words = split_words(row, nwords, width)
+        lines.append("  { {" + ", ".join(formatstr.format(w) for w in words) + "} },\n")
+    lines.append("};\n")
+    output.write("".join(lines))
 
 
 def calc_rowstride(rcols, width):
-    bound = 128 / width
+    bound = 128 // width
     if rcols > bound:
-        return ((rcols * (width / 8) + 31) & ~31) / (width / 8)
+        return ((rcols * (width // 8) + 31) & ~31) // (width // 8)
     else:
-        return ((rcols * (width / 8) + 15) & ~15) / (width / 8)
+        return ((rcols * (width // 8) + 15) & ~15) // (width // 8)
 
 
-def print_row_t(output, entries, formatstr):
-    while len(entries) % 4 != 0:
-        entries.append(formatstr.format(0))
-    strentries = []
-    for idx in range(len(entries) / 4):
-        strentries.append(
-            "{{{{ {} }}}}".format(", ".join(entries[idx * 4 : (idx + 1) * 4]))
-        )
-    output.write(", ".join(strentries))
+def format_row_t(entries, formatstr):
+    """
+    format the words in entries as initializers of block_t with four words each
+    """
+    if len(entries) % 4 != 0:
+        entries = entries + [formatstr.format(0)] * (4 - len(entries) % 4)
+    return ", ".join(
+        "{{ " + ", ".join(entries[idx:idx + 4]) + " }}" for idx in range(0, len(entries), 4)
+    )
 
 
-def print_matrix_mzd(output, name, typename, m, width=64):
-    rows = m.nrows()
-    cols = m.ncols()
-    rcols = (cols + width - 1) / width
+def mzd_lines(rows, ncols, width=64):
+    """
+    words of the packed rows of a matrix with ncols columns in the layout of mzd_local_t
+
+    The words are grouped as the lines of the C initializers, i.e., one row per line (two rows if
+    they fit into one block_t), and every line is padded to full block_t.
+    """
+    rcols = (ncols + width - 1) // width
     rowstride = calc_rowstride(rcols, width)
-    totalcols = rowstride * width
+    take_rows = 2 if rowstride == 2 else 1
+    for idx in range(0, len(rows), take_rows):
+        words = []
+        for row in rows[idx:idx + take_rows]:
+            words.extend(split_words(row, rowstride, width))
+        if len(words) % 4 != 0:
+            words.extend([0] * (4 - len(words) % 4))
+        yield words
+
+
+def print_rows_mzd(output, name, typename, rows, ncols, width=64):
+    """
+    write the packed rows of a matrix with ncols columns in the layout of mzd_local_t
+
+    Every table is formatted from the packed words and written with a single call.
+    """
     formatstr = uint_constant_fmtstr(width)
 
-    output.write("static const {type} {name}[]".format(type=typename, name=name))
-    output.write(" = {\n")
+    lines = ["static const {type} {name}[] = {{\n".format(type=typename, name=name)]
+    for words in mzd_lines(rows, ncols, width):
+        lines.append("  " + format_row_t([formatstr.format(w) for w in words], formatstr) + ",\n")
+    lines.append("};\n")
+    output.write("".join(lines))
 
-    take_rows = 2 if rowstride == 2 else 1
-    for idx in range(0, rows, take_rows):
-        tmp = []
-        for j in range(idx, min(rows, idx + take_rows)):
-            r = m.row(j)
-            for b in range(0, totalcols, width):
-                w = r[b : b + width] if b < cols else [0] * width
-                tmp.append(formatstr.format(combine_words(w)))
-        output.write("  ")
-        print_row_t(output, tmp, formatstr)
-        output.write(",\n")
-    output.write("};\n")
+
+def print_matrix_mzd(output, name, typename, m, width=64):
+    print_rows_mzd(output, name, typename, pack_rows(m), m.ncols(), width)
 
 
 def print_vector_mzd(output, name, typename, m, width=64):
-    rows = 1
-    cols = len(m)
-    rcols = (cols + width - 1) / width
-    rowstride = calc_rowstride(rcols, width)
-    totalcols = rowstride * width
     formatstr = uint_constant_fmtstr(width)
 
-    output.write("static const {type} {name}[]".format(type=typename, name=name))
-    output.write(" = {\n")
-    output.write("  ")
-    tmp = []
-    for b in range(0, totalcols, width):
-        w = m[b : b + width] if b < cols else [0] * width
-        tmp.append(formatstr.format(combine_words(w)))
-    print_row_t(output, tmp, formatstr)
-    # output.write(",\n")
-    output.write("};\n")
+    words = [formatstr.format(w) for w in next(mzd_lines([pack_vector(m)], len(m), width))]
+    output.write("static const {type} {name}[] = {{\n  {row}}};\n".format(
+        type=typename, name=name, row=format_row_t(words, formatstr)))
+
+
+class SourceTables(object):
+    """
+    write the tables as initialized arrays into the generated C code
+    """
+
+    def __init__(self, output, typename):
+        self.output = output
+        self.typename = typename
+
+    def rows(self, name, rows, ncols):
+        print_rows_mzd(self.output, name, self.typename, rows, ncols)
+
+    def matrix(self, name, m):
+        print_matrix_mzd(self.output, name, self.typename, m)
+
+    def vector(self, name, v):
+        print_vector_mzd(self.output, name, self.typename, v)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class BlobTables(object):
+    """
+    write the tables as little-endian words into a binary blob
+
+    The blob is included with .incbin by the generated C code, which defines the names of the
+    tables as pointers into the blob. Every table consists of full block_t and hence stays aligned
+    to 32 bytes. The blob has to be found by the assembler, e.g., by compiling in the directory of
+    the blob or by passing -Wa,-I<directory>.
+
+    The blob is written under a temporary name and only renamed by close(), so a failed emission
+    does not leave a truncated blob behind.
+    """
+
+    def __init__(self, output, typename, filename, symbol, width=64):
+        self.output = output
+        self.typename = typename
+        self.symbol = symbol
+        self.width = width
+        self.filename = filename
+        self.blob = io.open(filename + ".tmp", "wb")
+        self.offset = 0
+        output.write('''#define LOWMC_STR2(x) #x
+#define LOWMC_STR(x) LOWMC_STR2(x)
+#if defined(__APPLE__)
+#define LOWMC_TABLES_SECTION ".const_data"
+#else
+#define LOWMC_TABLES_SECTION ".section .rodata"
+#endif
+
+__asm__(LOWMC_TABLES_SECTION "\\n"
+        ".balign 32\\n"
+        ".globl " LOWMC_STR(__USER_LABEL_PREFIX__) "{symbol}\\n"
+        LOWMC_STR(__USER_LABEL_PREFIX__) "{symbol}:\\n"
+        ".incbin \\"{filename}\\"\\n"
+        ".text\\n");
+
+extern const {typename} {symbol}[];
+
+'''.format(symbol=symbol, filename=filename, typename=typename))
+
+    def _table(self, name, lines):
+        data = b"".join(w.to_bytes(self.width // 8, "little") for words in lines for w in words)
+        self.blob.write(data)
+        self.output.write("#define {name} ({symbol} + {offset})\n".format(
+            name=name, symbol=self.symbol, offset=self.offset))
+        # offset in units of block_t
+        self.offset += len(data) // (4 * self.width // 8)
+
+    def rows(self, name, rows, ncols):
+        self._table(name, mzd_lines(rows, ncols, self.width))
+
+    def matrix(self, name, m):
+        self.rows(name, pack_rows(m), m.ncols())
+
+    def vector(self, name, v):
+        self._table(name, mzd_lines([pack_vector(v)], len(v), self.width))
+
+    def close(self):
+        self.blob.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+    def abort(self):
+        self.blob.close()
+        os.remove(self.filename + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def m4ri_lookup(rows, ncols):
+    """
+    calculate the M4RI lookup table of the packed rows in the layout of
+    mzd_precompute_matrix_lookup, i.e., for every chunk of 8 rows all 256 combinations of these
+    rows
+    """
+    table = M4RITable(rows, ncols)
+    lookup = []
+    for chunk in table.tables:
+        lookup.extend(chunk + [0] * (256 - len(chunk)))
+    return lookup
+
+
+def table_size(nrows, ncols, width=64):
+    """
+    number of bytes of a table in the layout of mzd_local_t and the number of bytes of its rows
+    without the padding to calc_rowstride words and full block_t
+    """
+    stored = sum(len(words) for words in mzd_lines([0] * nrows, ncols, width)) * width // 8
+    return stored, nrows * ((ncols + width - 1) // width) * width // 8
+
+
+def product_cost(nrows, ncols, m4ri=False, width=64):
+    """
+    number of words read, XORs and ANDs of the product of a vector with a table
+
+    Without M4RI, every row of the table is masked with a bit of the vector and added to the
+    result. With M4RI, the table is the lookup table of the matrix with 256 rows for every chunk of
+    8 rows of the matrix, and one of these rows is added per chunk.
+    """
+    rowstride = calc_rowstride((ncols + width - 1) // width, width)
+    if m4ri:
+        words = nrows // 256 * rowstride
+        return words, words, 0
+    words = nrows * rowstride
+    return words, words, words
+
+
+VARIANTS = (
+    ("plain", ()),
+    ("rrkc", ("REDUCED_ROUND_KEY_COMPUTATION",)),
+    ("olle", ("REDUCED_ROUND_KEY_COMPUTATION", "OPTIMIZED_LINEAR_LAYER_EVALUATION")),
+)
+
+
+def variant_tables(variant, rounds):
+    """
+    names of the tables multiplied with a vector and of the vectors added in one encryption
+    """
+    if variant == "plain":
+        products = ["K_{}".format(i) for i in range(rounds + 1)]
+        products += ["L_{}".format(i) for i in range(rounds)]
+        vectors = ["C_{}".format(i) for i in range(rounds)]
+        return products, vectors
+
+    products = ["precomputed_round_key_matrix_linear_part",
+                "precomputed_round_key_matrix_non_linear_part"]
+    vectors = ["precomputed_constant_linear_part", "precomputed_constant_non_linear_part"]
+    if variant == "rrkc":
+        products += ["L_{}".format(i) for i in range(rounds)]
+    else:
+        products += ["Zi_{}".format(i) for i in range(rounds - 1)]
+        products += ["Ri_{}".format(i) for i in range(rounds - 1)]
+        products.append("Z_r")
+    return products, vectors
+
+
+def evaluation_cost(shapes, rounds, sboxes, width=64):
+    """
+    calculate the size of the constant tables of every variant and the cost of one encryption
+
+    shapes maps the name of every table to its number of rows and columns, the M4RI lookup tables
+    of a matrix X are named X_lookup. The S-box layer is the same in all variants and is not
+    counted, except for the addition of the non-linear part of the round key with RRKC.
+    """
+    tables = {}
+    for name, (nrows, ncols) in shapes.items():
+        stored, payload = table_size(nrows, ncols, width)
+        tables[name] = {
+            "rows": nrows,
+            "columns": ncols,
+            "bytes": stored,
+            "padding_bytes": stored - payload,
+        }
+
+    variants = {}
+    for variant, defines in VARIANTS:
+        products, vectors = variant_tables(variant, rounds)
+        for m4ri in (False, True):
+            used = products + vectors
+            words = xors = ands = 0
+            for name in products:
+                lookup = name + "_lookup"
+                if m4ri and lookup in shapes:
+                    used.append(lookup)
+                    cost = product_cost(*shapes[lookup], m4ri=True, width=width)
+                else:
+                    cost = product_cost(*shapes[name], width=width)
+                words += cost[0]
+                xors += cost[1]
+                ands += cost[2]
+            for name in vectors:
+                rowstride = calc_rowstride((shapes[name][1] + width - 1) // width, width)
+                words += rowstride
+                xors += rowstride
+            if variant != "plain":
+                # non-linear part of the round key, one word per round for 3 * sboxes <= 64
+                xors += rounds
+
+            # the matrices are still referenced by the rounds with M4RI
+            variants[variant + ("_m4ri" if m4ri else "")] = {
+                "defines": list(defines) + (["MUL_M4RI"] if m4ri else []),
+                "touched_bytes": words * width // 8,
+                "xor": xors,
+                "and": ands,
+                "table_bytes": sum(tables[name]["bytes"] for name in used),
+                "padding_bytes": sum(tables[name]["padding_bytes"] for name in used),
+            }
+    return {"word_size": width, "tables": tables, "variants": variants}
 
 
 def print_mzd(w, width=64):
@@ -180,147 +518,42 @@ def print_mzd(w, width=64):
     print("[" + "|".join(b64) + "]")
 
 
-def main(blocksize=256, keysize=256, rounds=19, sboxes=10):
-    with io.open(
-        "matrices_and_constants_{}_{}_{}.pickle".format(blocksize, keysize, rounds),
-        "rb",
-    ) as matfile:
-        inst = pickle.load(matfile)
+def main(blocksize=256, keysize=256, rounds=19, sboxes=10, m4ri_tables=False, blob=False,
+         cost_report=None):
+    """
+    Process the matrices and constants of a LowMC instance and write them as C code.
+
+    If m4ri_tables is set, the lookup tables used with MUL_M4RI are precomputed and emitted as
+    static const arrays, so that all generated objects are read-only in this case as well.
 
-    if inst.n != blocksize or inst.k != keysize or inst.r != rounds:
-        raise ValueError("Unexpected LowMC instance.")
+    If blob is set, the tables are written to the binary blob lowmc_n_k_r.bin instead, which is
+    included by the generated C code with .incbin. This keeps the C code small and fast to compile.
+
+    If cost_report is set, the sizes of the tables and the cost of an encryption with every
+    variant (see evaluation_cost) are written to this file as JSON.
+    """
     if blocksize != keysize:
         raise ValueError("Only blocksize == keysize is currently supported!")
-    if sboxes not in (10, 1):
-        raise ValueError("Pre-computation only implemented for m = 10 and m = 1")
-
-    P = matrix(F, blocksize, blocksize)
-    for i in range(blocksize):
-        P[blocksize - i - 1, i] = 1
-
-    Ls = [P * matrix(F, L) * P for L in inst.L]
-    Ks = [P * matrix(F, K) * P for K in inst.K]
-    Cs = [P * vector(F, C) for C in inst.R]
-
-    Lt = [m.transpose() for m in Ls]
-    K0t = Ks[0].transpose()
-
-    Li = [m.inverse() for m in Lt]
-    LiK = [Ks[i + 1].transpose() * Li[i] for i in range(inst.r)]
-    LiC = [Cs[i] * Li[i] for i in range(inst.r)]
-
-    mod_Li = [copy(Li[i]) for i in range(inst.r)]
-    for j in range(inst.r):
-        mod_Li[j][inst.n - 3 * sboxes :, : inst.n] = matrix(F, 3 * sboxes, inst.n)
-
-    if sboxes == 10:
-        precomputed_key_matrix = None
-        precomputed_key_matrix_nl = matrix(F, inst.n, (sboxes * 3 + 2) * inst.r)
-        precomputed_constant = None
-        precomputed_constant_nl = vector(F, (sboxes * 3 + 2) * inst.r)
-
-        for round in range(inst.r):
-            tmp = copy(LiK[round])
-            tmpC = copy(LiC[round])
-
-            for i in range(round + 1, inst.r):
-                x = LiK[i]
-                c = LiC[i]
-                for j in range(i - 1, round - 1, -1):
-                    x = x * mod_Li[j]
-                    c = c * mod_Li[j]
-                tmp += x
-                tmpC += c
-
-            # non-linear part
-            idx = round * (3 * sboxes + 2)
-            precomputed_key_matrix_nl[:inst.n, idx + 2:idx + 3 * sboxes + 2] = tmp[:inst.n, inst.n - 3*sboxes:]
-            precomputed_constant_nl[idx + 2:idx + 3 * sboxes + 2] = tmpC[inst.n - 3 * sboxes:]
-
-            # linear part
-            if round == 0:
-                tmp[:, inst.n - 3 * sboxes :] = matrix(F, inst.n, 3 * sboxes)
-                tmpC[inst.n - 3 * sboxes :] = vector(F, 3 * sboxes)
-                precomputed_key_matrix = tmp + K0t
-                precomputed_constant = tmpC
-    elif sboxes == 1:
-        num_64bit_words = (inst.r + 20) / 21
-        precomputed_key_matrix = None
-        precomputed_key_matrix_nl = matrix(F, inst.n, 64 * num_64bit_words)
-        precomputed_constant = None
-        precomputed_constant_nl = vector(F, 64 * num_64bit_words)
-
-        for round in range(inst.r):
-            tmp = copy(LiK[round])
-            tmpC = copy(LiC[round])
-
-            for i in range(round + 1, inst.r):
-                x = LiK[i]
-                c = LiC[i]
-                for j in range(i - 1, round - 1, -1):
-                    x = x * mod_Li[j]
-                    c = c * mod_Li[j]
-                tmp += x
-                tmpC += c
-
-            # non-linear part
-            idx = 1 + ((round % 21) * 3) + 64 * (round / 21)
-            precomputed_key_matrix_nl[:inst.n, idx:idx+3] = tmp[:inst.n, inst.n - 3*sboxes:]
-            precomputed_constant_nl[idx:idx + 3] = tmpC[inst.n - 3 * sboxes:]
-
-            # linear part
-            if round == 0:
-                tmp[:, inst.n - 3 * sboxes :] = matrix(F, inst.n, 3 * sboxes)
-                tmpC[inst.n - 3 * sboxes :] = vector(F, 3 * sboxes)
-                precomputed_key_matrix = tmp + K0t
-                precomputed_constant = tmpC
-    # RRKC precomputation done
-
-    Z_i = []
-    R_full = []
-    R_wedge_snipped = []
-    R_dot = []
-    R_dot_inv = []
-    R_wedge = []
-    R_cols = []
-    R_masks = []
-    T_vee = []
-
-    # i = 1
-    R_full.append(Lt[0][:, 0 : inst.n - 3 * sboxes])
-    Rdot, colR = calc_dot_from_full_rank(R_full[0])
-    R_dot.append(Rdot)
-    R_cols.append(colR)
-    R_masks.append(gen_masks_from_cols(colR, sboxes, inst.n))
-    R_dot_inv.append(R_dot[0].inverse())
-
-    R_wedge.append(R_full[0] * R_dot_inv[0])
-    Z_i.append(Lt[0][:, inst.n - 3 * sboxes : inst.n])
-    R_wedge_snipped.append(snip_r_wedge(R_wedge[0], colR))
-
-    # i = 2...r-1
-    for i in range(1,rounds-1):
-        T_vee.append(R_dot[i-1] * Lt[i][0:inst.n-sboxes*3,:])
-        R = matrix(F, inst.n, inst.n-sboxes*3)
-        R[0:inst.n-3*sboxes, :] = T_vee[-1][0:inst.n-3*sboxes, 0:inst.n-3*sboxes]
-        R[inst.n-3*sboxes:inst.n, :] = Lt[i][inst.n-3*sboxes:inst.n, 0:inst.n-3*sboxes]
-        R_full.append(R)
-        Rdot, colR = calc_dot_from_full_rank(R_full[i])
-        R_dot.append(Rdot)
-        R_cols.append(colR)
-        R_masks.append(gen_masks_from_cols(colR, sboxes, inst.n))
-        R_dot_inv.append(R_dot[i].inverse())
-        R_wedge.append(R_full[i]*R_dot_inv[i])
-        Z_i.append(T_vee[i-1][0:inst.n-3*sboxes, inst.n-3*sboxes:inst.n].transpose().augment(Lt[i][inst.n-sboxes*3:inst.n, inst.n-sboxes*3:inst.n].transpose()).transpose())
-        R_wedge_snipped.append(snip_r_wedge(R_wedge[-1],colR))
-
-    # i = r
-    T_vee.append(R_dot[rounds-2] * Lt[rounds-1][0:inst.n-sboxes*3,:])
-    Z_r = T_vee[-1].transpose().augment(Lt[-1][inst.n-sboxes*3:inst.n, :].transpose()).transpose()
-    # RLL precomputation done
-
-    with io.open("lowmc_{}_{}_{}.h".format(inst.n, inst.k, inst.r), "w") as matfile:
-        matfile.write('''#ifndef LOWMC_{inst.n}_{inst.k}_{inst.r}_H
+    if 3 * sboxes > 64:
+        raise ValueError("The optimized linear layer evaluation requires 3 * m <= 64, i.e., "
+                         "m <= 21; whether it applies to a given m also depends on the "
+                         "matrices of the instance")
+
+    nl_layout = NonLinearLayout(sboxes, rounds)
+    nl_offsets = nl_layout.offsets
+    nl_columns = nl_layout.columns
+
+    m4ri_const = "const " if m4ri_tables else ""
+    lookup = "{}_lookup" if m4ri_tables else "NULL"
+
+    # a cache hit would skip the precomputations, profile them instead
+    cache = PrecomputationCache("" if PROFILE.enabled else None)
+    with open_instance(blocksize, keysize, rounds) as inst, \
+            replace_file('lowmc_{}_{}_{}.c'.format(blocksize, keysize, rounds)) as matfile, \
+            contextlib.ExitStack() as stack:
+        with io.open("lowmc_{}_{}_{}.h".format(inst.n, inst.k, inst.r), "w") as header, \
+                PROFILE.phase("emit header"):
+            header.write('''#ifndef LOWMC_{inst.n}_{inst.k}_{inst.r}_H
 #define LOWMC_{inst.n}_{inst.k}_{inst.r}_H
 
 #include "lowmc_pars.h"
@@ -328,13 +561,14 @@ def main(blocksize=256, keysize=256, rounds=19, sboxes=10):
 #if !defined(MUL_M4RI)
 extern const lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r};
 #else
-extern lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r};
+extern {m4ri_const}lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r};
 #endif
 
-#endif
-'''.format(s=inst.n / 64, inst=inst))
+/* layout of precomputed_round_key_matrix_non_linear_part and precomputed_constant_non_linear_part */
+'''.format(s=inst.n // 64, inst=inst, m4ri_const=m4ri_const))
+            nl_layout.write_defines(header, "LOWMC_{}_{}_{}".format(inst.n, inst.k, inst.r))
+            header.write("\n#endif\n")
 
-    with io.open('lowmc_{}_{}_{}.c'.format(inst.n, inst.k, inst.r), 'w') as matfile:
         matfile.write('''#ifdef HAVE_CONFIG_H
 #include <config.h>
 #endif
@@ -346,60 +580,102 @@ extern lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r};
 '''.format(inst=inst))
 
         typename = 'block_t'
-
-        matfile.write('#if !defined(OPTIMIZED_LINEAR_LAYER_EVALUATION)\n')
-        for i, L in enumerate(Ls):
-            print_matrix_mzd(matfile, 'L_{}'.format(i),
-                    typename, L.transpose())
-            matfile.write('\n')
-        matfile.write('#endif\n')
-
-        matfile.write('#if !defined(REDUCED_ROUND_KEY_COMPUTATION)')
-        for i, K in enumerate(Ks):
-            matfile.write('\n')
-            print_matrix_mzd(matfile, 'K_{}'.format(i),
-                    typename, K.transpose())
-
-        for i, C in enumerate(Cs):
-            matfile.write('\n')
-            print_vector_mzd(matfile, 'C_{}'.format(i),
-                    typename, C)
-        matfile.write('#endif\n')
-
+        if blob:
+            tables = BlobTables(matfile, typename, 'lowmc_{}_{}_{}.bin'.format(inst.n, inst.k, inst.r),
+                    'lowmc_{}_{}_{}_tables'.format(inst.n, inst.k, inst.r))
+        else:
+            tables = SourceTables(matfile, typename)
+        # closes the tables at the end of the emission, discards them if it fails
+        stack.enter_context(tables)
+
+        # L_i, K_i and C_i do not depend on the precomputations, they are streamed round by round
+        # from the instance file before the precomputations run
+        with PROFILE.phase("emit instance"):
+            write_instance_tables(matfile, tables, inst)
+
+        with PROFILE.phase("load"):
+            Lt, Kt, Cs, Li = load_matrices(inst)
+            digest = instance_digest(inst) if cache.enabled else None
+
+        with PROFILE.phase("rrkc"):
+            rrkc = cache.get_or_compute(digest, "rrkc", sboxes,
+                                        lambda: compute_rrkc(Lt, Kt, Cs, inst.n, sboxes, Li))
+        key_nl = rrkc["key_nl"]
+        constant_nl = rrkc["constant_nl"]
+        precomputed_key_matrix = rrkc["key_linear"] + Kt[0]
+        precomputed_constant = rrkc["constant_linear"]
+
+        precomputed_key_matrix_nl = matrix(F, inst.n, nl_columns)
+        precomputed_constant_nl = vector(F, nl_columns)
+        for round, idx in enumerate(nl_offsets):
+            precomputed_key_matrix_nl[:inst.n, idx:idx + 3 * sboxes] = key_nl[round]
+            precomputed_constant_nl[idx:idx + 3 * sboxes] = constant_nl[round]
+        # RRKC precomputation done
+
+        with PROFILE.phase("rll"):
+            rll = cache.get_or_compute(digest, "rll", sboxes,
+                                       lambda: compute_rll(Lt, inst.n, sboxes))
+        Z_i = rll["Z_i"]
+        Z_r = rll["Z_r"]
+        R_masks = [gen_masks_from_cols(colR, sboxes, inst.n) for colR in rll["R_cols"]]
+        R_wedge_snipped = [snip_r_wedge(Rwedge, colR) for Rwedge, colR in zip(rll["R_wedge"], rll["R_cols"])]
+        # RLL precomputation done
+
+        # the remaining tables, until the end of the emission
+        stack.enter_context(PROFILE.phase("emit source"))
         matfile.write('#if defined(REDUCED_ROUND_KEY_COMPUTATION)\n')
-        print_matrix_mzd(matfile, 'precomputed_round_key_matrix_linear_part',
-                    typename, precomputed_key_matrix)
+        tables.matrix('precomputed_round_key_matrix_linear_part', precomputed_key_matrix)
         matfile.write('\n')
 
-        print_matrix_mzd(matfile, 'precomputed_round_key_matrix_non_linear_part',
-                    typename, precomputed_key_matrix_nl)
+        tables.matrix('precomputed_round_key_matrix_non_linear_part', precomputed_key_matrix_nl)
         matfile.write('\n')
 
-        print_vector_mzd(matfile, 'precomputed_constant_linear_part', typename, precomputed_constant)
+        tables.vector('precomputed_constant_linear_part', precomputed_constant)
         matfile.write('\n')
-        print_vector_mzd(matfile, 'precomputed_constant_non_linear_part', typename, precomputed_constant_nl)
+        tables.vector('precomputed_constant_non_linear_part', precomputed_constant_nl)
 
         matfile.write('\n')
         matfile.write('#if defined(OPTIMIZED_LINEAR_LAYER_EVALUATION)\n')
-        print_matrix_mzd(matfile, 'Z_r', typename, Z_r)
+        tables.matrix('Z_r', Z_r)
         for i, Z in enumerate(Z_i):
             matfile.write('\n')
-            print_matrix_mzd(matfile, 'Zi_{}'.format(i), typename, Z.transpose())
+            tables.matrix('Zi_{}'.format(i), Z.transpose())
 
         for i, R in enumerate(R_wedge_snipped):
             matfile.write('\n')
-            print_matrix_mzd(matfile, 'Ri_{}'.format(i), typename, R)
+            tables.matrix('Ri_{}'.format(i), R)
 
         matfile.write('#endif\n')
         matfile.write('#endif\n\n')
 
+        if m4ri_tables:
+            matfile.write('#if defined(MUL_M4RI)\n')
+            matfile.write('#if !defined(OPTIMIZED_LINEAR_LAYER_EVALUATION)\n')
+            for i, L in enumerate(Lt):
+                tables.rows('L_{}_lookup'.format(i), m4ri_lookup(pack_rows(L), inst.n), inst.n)
+                matfile.write('\n')
+            matfile.write('#endif\n')
+
+            matfile.write('#if !defined(REDUCED_ROUND_KEY_COMPUTATION)\n')
+            for i, K in enumerate(Kt):
+                tables.rows('K_{}_lookup'.format(i), m4ri_lookup(pack_rows(K), inst.n), inst.n)
+                matfile.write('\n')
+            matfile.write('#else\n')
+            tables.rows('precomputed_round_key_matrix_linear_part_lookup',
+                    m4ri_lookup(pack_rows(precomputed_key_matrix), inst.n), inst.n)
+            matfile.write('\n')
+            tables.rows('precomputed_round_key_matrix_non_linear_part_lookup',
+                    m4ri_lookup(pack_rows(precomputed_key_matrix_nl), nl_columns), nl_columns)
+            matfile.write('#endif\n')
+            matfile.write('#endif\n\n')
+
         matfile.write(
 '''#if defined(MUL_M4RI)
-static lowmc_round_t rounds[{inst.r}] = {{
+static {m4ri_const}lowmc_round_t rounds[{inst.r}] = {{
 #else
 static const lowmc_round_t rounds[{inst.r}] = {{
 #endif
-'''.format(inst=inst))
+'''.format(inst=inst, m4ri_const=m4ri_const))
         for i in range(inst.r):
             if i != inst.r-1:
                 matfile.write(
@@ -407,7 +683,7 @@ static const lowmc_round_t rounds[{inst.r}] = {{
   {{
 #if !defined(REDUCED_ROUND_KEY_COMPUTATION)
 #if defined(MUL_M4RI)
-    K_{j}, L_{i}, C_{i}, NULL, NULL
+    K_{j}, L_{i}, C_{i}, {K_lookup}, {L_lookup}
 #else
     K_{j}, L_{i}, C_{i}
 #endif
@@ -416,20 +692,21 @@ static const lowmc_round_t rounds[{inst.r}] = {{
     Zi_{i}, Ri_{i}, {R_mask},
 #else
 #if defined(MUL_M4RI)
-    L_{i}, NULL
+    L_{i}, {L_lookup}
 #else
     L_{i}
 #endif
 #endif
 #endif
-  }},'''.format(inst=inst, i=i, j=i+1, R_mask=uint_constant_fmtstr(64).format(R_masks[i])))
+  }},'''.format(inst=inst, i=i, j=i+1, R_mask=uint_constant_fmtstr(64).format(R_masks[i]),
+        K_lookup=lookup.format('K_{}'.format(i+1)), L_lookup=lookup.format('L_{}'.format(i))))
             else:
                 matfile.write(
 '''
   {{
 #if !defined(REDUCED_ROUND_KEY_COMPUTATION)
 #if defined(MUL_M4RI)
-    K_{j}, L_{i}, C_{i}, NULL, NULL
+    K_{j}, L_{i}, C_{i}, {K_lookup}, {L_lookup}
 #else
     K_{j}, L_{i}, C_{i}
 #endif
@@ -438,20 +715,29 @@ static const lowmc_round_t rounds[{inst.r}] = {{
     NULL, NULL, 0,
 #else
 #if defined(MUL_M4RI)
-    L_{i}, NULL
+    L_{i}, {L_lookup}
 #else
     L_{i}
 #endif
 #endif
 #endif
-  }},'''.format(inst=inst, i=i, j=i+1))
+  }},'''.format(inst=inst, i=i, j=i+1,
+        K_lookup=lookup.format('K_{}'.format(i+1)), L_lookup=lookup.format('L_{}'.format(i))))
 
+        if m4ri_tables:
+            K0_lookup = '''#if defined(REDUCED_ROUND_KEY_COMPUTATION)
+  precomputed_round_key_matrix_linear_part_lookup,
+#else
+  K_0_lookup,
+#endif'''
+        else:
+            K0_lookup = '  NULL,'
         matfile.write(
 '''
 }};
 
 #if defined(MUL_M4RI)
-lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r} = {{
+{m4ri_const}lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r} = {{
 #else
 const lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r} = {{
 #endif
@@ -465,26 +751,66 @@ const lowmc_t lowmc_{inst.n}_{inst.k}_{inst.r} = {{
   Z_r,
 #endif
 #if defined(MUL_M4RI)
-  NULL,
+{K0_lookup}
 #endif
   rounds,
 #if defined(REDUCED_ROUND_KEY_COMPUTATION)
   precomputed_round_key_matrix_non_linear_part,
 #if defined(MUL_M4RI)
-  NULL,
+  {nl_lookup},
 #endif
   precomputed_constant_linear_part,
   precomputed_constant_non_linear_part,
 #endif
 }};
 
-'''.format(inst=inst, m=sboxes))
+'''.format(inst=inst, m=sboxes, m4ri_const=m4ri_const, K0_lookup=K0_lookup,
+        nl_lookup=lookup.format('precomputed_round_key_matrix_non_linear_part')))
+
+    if cost_report is not None:
+        shapes = {}
+        for name, m in ([('L_{}'.format(i), L) for i, L in enumerate(Lt)] +
+                        [('K_{}'.format(i), K) for i, K in enumerate(Kt)] +
+                        [('precomputed_round_key_matrix_linear_part', precomputed_key_matrix),
+                         ('precomputed_round_key_matrix_non_linear_part',
+                          precomputed_key_matrix_nl)]):
+            shapes[name] = (m.nrows(), m.ncols())
+            shapes[name + '_lookup'] = ((m.nrows() + 7) // 8 * 256, m.ncols())
+        for name, m in ([('Zi_{}'.format(i), Z.transpose()) for i, Z in enumerate(Z_i)] +
+                        [('Ri_{}'.format(i), R) for i, R in enumerate(R_wedge_snipped)] +
+                        [('Z_r', Z_r)]):
+            shapes[name] = (m.nrows(), m.ncols())
+        for name, v in ([('C_{}'.format(i), C) for i, C in enumerate(Cs)] +
+                        [('precomputed_constant_linear_part', precomputed_constant),
+                         ('precomputed_constant_non_linear_part', precomputed_constant_nl)]):
+            shapes[name] = (1, len(v))
+
+        costs = evaluation_cost(shapes, inst.r, sboxes)
+        costs['instance'] = {'n': inst.n, 'k': inst.k, 'r': inst.r, 'sboxes': sboxes}
+        with io.open(cost_report, 'w') as f:
+            f.write(json.dumps(costs, indent=2, sort_keys=True))
 
 if __name__ == "__main__":
     import sys
 
-    if len(sys.argv) == 5:
-        blocksize, keysize, rounds, sboxes = map(int, sys.argv[1:5])
-        main(blocksize, keysize, rounds, sboxes)
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    m4ri_tables = "--m4ri-tables" in flags
+    blob = "--blob" in flags
+
+    if len(args) == 4:
+        params = tuple(map(int, args))
     else:
-        main()
+        params = (256, 256, 19, 10)
+    cost_report = None
+    for flag in flags:
+        if flag == "--cost-report":
+            cost_report = "lowmc_{}_{}_{}_cost.json".format(*params[:3])
+        elif flag.startswith("--cost-report="):
+            cost_report = flag[len("--cost-report="):]
+
+    report = profile_filename(flags, "profile_process_{}_{}_{}.json".format(*params[:3]))
+    PROFILE.enabled = report is not None
+    main(*params, m4ri_tables=m4ri_tables, blob=blob, cost_report=cost_report)
+    if report is not None:
+        PROFILE.write(report)
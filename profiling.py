@@ -0,0 +1,126 @@
+"""
+timers and operation counters of the generation and processing of the matrices
+
+The instrumentation is disabled by default: PROFILE.phase and PROFILE.round then return a shared
+no-op context manager and PROFILE.count returns immediately. Pass --profile to
+generate_matrices.py or process_matrices.py to enable it and to write the report as JSON.
+
+The report contains for every phase the number of calls, the total time, the peak RSS of the
+process at its end and by how much the phase increased it, for every round timer the time of every
+round by round number, and the counters. Round timers are reported separately from the phases, so
+a phase and the rounds within it may share a name.
+"""
+
+import io
+import json
+import resource
+import sys
+import time
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def peak_rss():
+    """
+    peak resident set size of the current process in KiB
+    """
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class _Timer(object):
+    def __init__(self, profile, name, round=None):
+        self.profile = profile
+        self.name = name
+        self.round = round
+
+    def __enter__(self):
+        if self.round is None:
+            self.rss = peak_rss()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.time() - self.start
+        profile = self.profile
+        if self.round is not None:
+            # only in the rounds, the enclosing phase of the same name measures the total
+            rounds = profile.rounds.setdefault(self.name, {})
+            rounds[self.round] = rounds.get(self.round, 0.0) + elapsed
+            return False
+        timer = profile.timers.setdefault(self.name, {"calls": 0, "time": 0.0})
+        timer["calls"] += 1
+        timer["time"] += elapsed
+        rss = peak_rss()
+        timer["peak_rss"] = rss
+        timer["peak_rss_increase"] = timer.get("peak_rss_increase", 0) + rss - self.rss
+        return False
+
+
+class Profile(object):
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.timers = {}
+        self.rounds = {}
+        self.counters = {}
+
+    def phase(self, name):
+        """
+        context manager measuring the time and the peak RSS of a phase
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def round(self, name, round):
+        """
+        context manager measuring the time of one round of a phase
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, round)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {
+            "timers": self.timers,
+            # keyed by round number, the rounds of a timer need not start at 0
+            "rounds": dict((name, dict(rounds)) for name, rounds in self.rounds.items()),
+            "counters": self.counters,
+            "peak_rss": peak_rss(),
+        }
+
+    def write(self, filename):
+        with io.open(filename, "w") as f:
+            f.write(json.dumps(self.report(), indent=2, sort_keys=True))
+
+
+PROFILE = Profile()
+
+
+def profile_filename(flags, default):
+    """
+    return the file name of the report given by --profile[=filename] in flags, or None
+    """
+    for flag in flags:
+        if flag == "--profile":
+            return default
+        if flag.startswith("--profile="):
+            return flag[len("--profile="):]
+    return None
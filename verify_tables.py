@@ -0,0 +1,257 @@
+#! /usr/bin/env python3
+
+"""
+Verify the tables of the generated C code by encrypting with them.
+
+The tables of lowmc_n_k_r.c (or of the blob it includes) are parsed back into packed rows in the
+layout of mzd_local_t, and LowMC with REDUCED_ROUND_KEY_COMPUTATION and
+OPTIMIZED_LINEAR_LAYER_EVALUATION is evaluated as in the C code: the S-boxes add the non-linear
+part of the round key at the offsets of the layout defined in lowmc_n_k_r.h, Zi_i is evaluated as
+the parities of the state with its rows, the last word of the state is shuffled with the R_mask of
+the round and the shuffled bits are multiplied with Ri_i. A batch of random keys and plaintexts is
+encrypted bitsliced and compared with LowMC.enc.
+
+Run it in the directory of the generated code and the instance files.
+"""
+
+from __future__ import print_function
+
+import io
+import random
+import re
+import sys
+
+from build_all import PARAMETER_SETS
+from gf2 import bitslice, unbitslice, bitsliced_vecmat, bitsliced_matvec, bitsliced_add, \
+    bitsliced_add_constant
+from lowmc import LowMC
+from backend import pack_vector, unpack_vector
+from process_matrices import calc_rowstride, mzd_lines
+
+WORD = re.compile(r"UINT64_C\(0x([0-9a-f]+)\)")
+
+
+def unpack_mzd(words, nrows, ncols, width=64):
+    """
+    packed rows of a table with nrows rows and ncols columns given by its words in the layout of
+    mzd_local_t, i.e., as written by print_rows_mzd
+
+    Raises ValueError if the table is too short or if a padding bit is set.
+    """
+    rowstride = calc_rowstride((ncols + width - 1) // width, width)
+    take_rows = 2 if rowstride == 2 else 1
+    lines = [len(line) for line in mzd_lines([0] * nrows, ncols, width)]
+    if sum(lines) > len(words):
+        raise ValueError("table has {} words, expected {}".format(len(words), sum(lines)))
+
+    rows = []
+    offset = 0
+    for length in lines:
+        line = words[offset:offset + length]
+        offset += length
+        used = min(take_rows, nrows - len(rows)) * rowstride
+        for idx in range(0, used, rowstride):
+            row = 0
+            for j, word in enumerate(line[idx:idx + rowstride]):
+                row |= word << (j * width)
+            if row >> ncols:
+                raise ValueError("padding bits of row {} are set".format(len(rows)))
+            rows.append(row)
+        if any(line[used:]):
+            raise ValueError("padding words of row {} are set".format(len(rows) - 1))
+    return rows
+
+
+class GeneratedTables(object):
+    """
+    tables of the generated C code lowmc_n_k_r.c, either as initialized arrays or as blob
+    """
+
+    def __init__(self, n, k, r, width=64):
+        self.width = width
+        name = "lowmc_{}_{}_{}".format(n, k, r)
+        with io.open(name + ".c") as f:
+            source = f.read()
+        with io.open(name + ".h") as f:
+            header = f.read()
+
+        self.arrays = dict(
+            (table, [int(w, 16) for w in WORD.findall(body)])
+            for table, body in re.findall(r"static const block_t (\w+)\[\] = \{(.*?)\};", source,
+                                          re.DOTALL)
+        )
+        self.offsets = dict(
+            (table, int(offset)) for table, offset in re.findall(
+                r"#define (\w+) \(\w+ \+ (\d+)\)", source)
+        )
+        self.blob = None
+        blob = re.search(r'\.incbin \\"([^"\\]+)\\"', source)
+        if blob is not None:
+            with io.open(blob.group(1), "rb") as f:
+                data = f.read()
+            nbytes = width // 8
+            self.blob = [int.from_bytes(data[i:i + nbytes], "little")
+                         for i in range(0, len(data), nbytes)]
+
+        parameters = re.search(
+            r"lowmc_t {} = \{{\n#endif\n  (\d+), (\d+), (\d+), (\d+),".format(name), source)
+        if parameters is None:
+            raise ValueError("{}.c does not define {}".format(name, name))
+        self.sboxes, n_, r_, k_ = map(int, parameters.groups())
+        if (n_, k_, r_) != (n, k, r):
+            raise ValueError("{}.c defines an instance with n={}, k={}, r={}".format(
+                name, n_, k_, r_))
+
+        self.masks = dict(
+            (int(i), int(mask, 16)) for i, mask in re.findall(
+                r"Zi_(\d+), Ri_\1, UINT64_C\(0x([0-9a-f]+)\)", source)
+        )
+        self.layout = dict(
+            (define, int(value)) for define, value in re.findall(
+                r"#define {}_NL_(\w+) (\d+)".format(name.upper()), header)
+        )
+
+    def rows(self, table, nrows, ncols):
+        if table in self.arrays:
+            words = self.arrays[table]
+            expected = sum(len(line) for line in mzd_lines([0] * nrows, ncols, self.width))
+            if len(words) != expected:
+                raise ValueError("{} has {} words, expected {}".format(table, len(words), expected))
+        elif table in self.offsets and self.blob is not None:
+            # offsets are given in block_t, i.e., in units of four words
+            words = self.blob[4 * self.offsets[table]:]
+        else:
+            raise KeyError("{} is not defined".format(table))
+        try:
+            return unpack_mzd(words, nrows, ncols, self.width)
+        except ValueError as e:
+            raise ValueError("{}: {}".format(table, e))
+
+    def vector(self, table, ncols):
+        return self.rows(table, 1, ncols)[0]
+
+    def nl_offsets(self, rounds):
+        """
+        column of the non-linear part of the round key of every round
+        """
+        bits = self.layout["BITS"]
+        slot_bits = self.layout["SLOT_BITS"]
+        rounds_per_slot = self.layout["ROUNDS_PER_SLOT"]
+        slot_offset = self.layout["SLOT_OFFSET"]
+        return [
+            (i // rounds_per_slot) * slot_bits + slot_offset + (i % rounds_per_slot) * bits
+            for i in range(rounds)
+        ]
+
+
+def shuffle(slices, mask, n, width=64):
+    """
+    permute the bits of the last word of the bitsliced state as mzd_shuffle: the bits selected by
+    mask are moved to the top of the word, the remaining ones to the bottom, both in order
+    """
+    base = n - width
+    selected = [b for b in range(width) if (mask >> b) & 1]
+    remaining = [b for b in range(width) if not (mask >> b) & 1]
+    return slices[:base] + [slices[base + b] for b in remaining + selected]
+
+
+def enc_tables(tables, n, k, r, keys, plaintexts):
+    """
+    encrypt the packed plaintexts with the packed keys using the generated tables
+    """
+    sboxes = tables.sboxes
+    nl = 3 * sboxes
+    linear = n - nl
+    offsets = tables.nl_offsets(r)
+    nl_columns = offsets[-1] + nl
+    nl_columns += (-nl_columns) % tables.layout["SLOT_BITS"]
+
+    key = tables.rows("precomputed_round_key_matrix_linear_part", k, n)
+    key_nl = tables.rows("precomputed_round_key_matrix_non_linear_part", k, nl_columns)
+    constant = tables.vector("precomputed_constant_linear_part", n)
+    constant_nl = tables.vector("precomputed_constant_non_linear_part", nl_columns)
+    Zi = [tables.rows("Zi_{}".format(i), nl, n) for i in range(r - 1)]
+    Ri = [tables.rows("Ri_{}".format(i), nl, linear) for i in range(r - 1)]
+    Z_r = tables.rows("Z_r", n, n)
+    masks = [tables.masks[i] for i in range(r - 1)]
+    for i, mask in enumerate(masks):
+        if bin(mask).count("1") != nl:
+            raise ValueError("R_mask of round {} selects {} bits".format(i, bin(mask).count("1")))
+
+    count = len(plaintexts)
+    ones = (1 << count) - 1
+    sk = bitslice(keys, k)
+    x = bitslice(plaintexts, n)
+
+    v = bitsliced_add_constant(bitsliced_vecmat(sk, key_nl, nl_columns), constant_nl, ones)
+    x = bitsliced_add(x, bitsliced_vecmat(sk, key, n))
+    x = bitsliced_add_constant(x, constant, ones)
+    for i in range(r - 1):
+        x = LowMC._S_bitsliced(x, n, sboxes)
+        x[linear:] = bitsliced_add(x[linear:], v[offsets[i]:offsets[i] + nl])
+        z = bitsliced_matvec(Zi[i], x)
+        x = shuffle(x, masks[i], n)
+        x = bitsliced_add(x[:linear], bitsliced_vecmat(x[linear:], Ri[i], linear)) + z
+    x = LowMC._S_bitsliced(x, n, sboxes)
+    x[linear:] = bitsliced_add(x[linear:], v[offsets[-1]:offsets[-1] + nl])
+    return unbitslice(bitsliced_vecmat(x, Z_r, n), count)
+
+
+def verify(n, k, r, s, blocks=1024, seed=0):
+    """
+    encrypt blocks random plaintexts with the generated tables and compare with LowMC, return the
+    number of mismatches
+    """
+    tables = GeneratedTables(n, k, r)
+    if tables.sboxes != s:
+        raise ValueError("lowmc_{}_{}_{}.c has {} S-boxes, expected {}".format(
+            n, k, r, tables.sboxes, s))
+    rng = random.Random(seed)
+    keys = [rng.getrandbits(k) for _ in range(blocks)]
+    plaintexts = [rng.getrandbits(n) for _ in range(blocks)]
+
+    lowmc = LowMC(n, k, s, r)
+    expected = lowmc.enc_batch(keys, plaintexts)
+    # tie the batch encryption to the reference implementation
+    for key, plaintext, ciphertext in list(zip(keys, plaintexts, expected))[:2]:
+        if pack_vector(lowmc.enc(unpack_vector(key, k), unpack_vector(plaintext, n))) != ciphertext:
+            raise RuntimeError("enc_batch differs from enc")
+
+    ciphertexts = enc_tables(tables, n, k, r, keys, plaintexts)
+    return sum(1 for c, e in zip(ciphertexts, expected) if c != e)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("instance", nargs="*", type=int, metavar="n k r s",
+                        help="parameters of the instance (default: all instances)")
+    parser.add_argument("--blocks", type=int, default=1024,
+                        help="number of random blocks to encrypt")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.instance:
+        if len(args.instance) != 4:
+            parser.error("expected n k r s")
+        parameter_sets = [tuple(args.instance)]
+    else:
+        parameter_sets = PARAMETER_SETS
+
+    failed = False
+    for n, k, r, s in parameter_sets:
+        try:
+            mismatches = verify(n, k, r, s, args.blocks, args.seed)
+        except (ValueError, KeyError) as e:
+            print("lowmc_{}_{}_{}: {}".format(n, k, r, e))
+            failed = True
+            continue
+        if mismatches:
+            print("lowmc_{}_{}_{}: {} of {} blocks differ".format(n, k, r, mismatches, args.blocks))
+            failed = True
+        else:
+            print("lowmc_{}_{}_{}: OK".format(n, k, r))
+    sys.exit(1 if failed else 0)